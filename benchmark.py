@@ -0,0 +1,289 @@
+import argparse
+import contextlib
+import json
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+import main
+import transfer
+from metadata import datetime_original_tag, exif_ifd_pointer
+
+# Where the results of a reference run are kept, to compare the next ones with.
+baseline_name = 'benchmark_baseline.json'
+stages = ['listing', 'pull', 'indexing', 'placement', 'verification']
+phone_dir = '/DCIM/Camera/'
+
+
+class FakeAdbDevice(object):
+    """
+    In-process stand-in of AdbDeviceTcp serving a local folder as the device storage.
+    Listing and pulls go straight to the filesystem; shell commands (find, tar, sha256sum, rm...) are run by the local
+    shell with the device routes mapped to the folder. The link can be slowed down to mimic a real network.
+    """
+
+    def __init__(self, host, port=5555, default_transport_timeout_s=None, storage=None, link_mbps=None):
+        super(FakeAdbDevice, self).__init__()
+        self.host = host
+        self.storage = storage
+        self.link_mbps = link_mbps
+        self.available = False
+
+    def connect(self, rsa_keys=None, auth_timeout_s=None, **kwargs):
+        self.available = True
+        return True
+
+    def close(self):
+        self.available = False
+
+    def list(self, device_path, transport_timeout_s=None, read_timeout_s=None):
+        entries = []
+        with os.scandir(self.local(device_path)) as files:
+            for file in files:
+                st = file.stat()
+                entries.append(types.SimpleNamespace(filename=file.name.encode('utf-8'), mode=st.st_mode,
+                                                     size=st.st_size, mtime=int(st.st_mtime)))
+        return entries
+
+    def stat(self, device_path, transport_timeout_s=None, read_timeout_s=None):
+        st = os.stat(self.local(device_path))
+        return st.st_mode, st.st_size, int(st.st_mtime)
+
+    def pull(self, device_path, local_path, progress_callback=None, transport_timeout_s=None, read_timeout_s=None):
+        total = os.path.getsize(self.local(device_path))
+        written = 0
+        with open(self.local(device_path), 'rb') as f_in, open(local_path, 'wb') as f_out:
+            for chunk in iter(lambda: f_in.read(64 * 1024), b''):
+                self.throttle(len(chunk))
+                f_out.write(chunk)
+                written += len(chunk)
+                if progress_callback is not None:
+                    progress_callback(device_path, written, total)
+
+    def shell(self, command, transport_timeout_s=None, read_timeout_s=None, **kwargs):
+        if command.startswith('getprop ro.serialno'):
+            return 'BENCHMARK\n'
+        return subprocess.run(['sh', '-c', self.local_command(command)], capture_output=True).stdout.decode('utf-8')
+
+    def streaming_shell(self, command, transport_timeout_s=None, read_timeout_s=None, decode=True):
+        process = subprocess.Popen(['sh', '-c', self.local_command(command)], stdout=subprocess.PIPE)
+        for chunk in iter(lambda: process.stdout.read(64 * 1024), b''):
+            self.throttle(len(chunk))
+            # find prints the local routes, the device ones are expected.
+            chunk = chunk.replace(self.storage.encode('utf-8'), b'')
+            yield chunk.decode('utf-8') if decode else chunk
+        process.wait()
+
+    def local(self, device_path):
+        return self.storage + device_path
+
+    # Maps the absolute device routes of a command to the storage folder.
+    def local_command(self, command):
+        return command.replace(" /", " " + self.storage + "/").replace("'/", "'" + self.storage + "/")
+
+    def throttle(self, size):
+        if self.link_mbps:
+            time.sleep(size / (self.link_mbps * 1024 * 1024))
+
+
+def fake_device_class(storage, link_mbps=None):
+    # AdbDeviceTcp replacement bound to the given storage folder.
+    def device(host, port=5555, default_transport_timeout_s=None):
+        return FakeAdbDevice(host, port, default_transport_timeout_s, storage=storage, link_mbps=link_mbps)
+    return device
+
+
+def make_jpeg(date, size, rng):
+    """
+    Builds a minimal JPEG file: EXIF segment with DateTimeOriginal (if a date is given) and random image data.
+    :param date: The date, as a string (YYYY:MM:DD hh:mm:ss), or None.
+    :param size: The approximate size of the file, in bytes.
+    :param rng: random.Random used for the image data.
+    :return: bytes
+    """
+    data = b'\xff\xd8'
+    if date is not None:
+        # Little endian TIFF: IFD0 with the EXIF pointer, EXIF IFD with DateTimeOriginal and then its value.
+        tiff = b'II*\x00' + struct.pack('<I', 8)
+        tiff += struct.pack('<HHHII', 1, exif_ifd_pointer, 4, 1, 26) + struct.pack('<I', 0)
+        tiff += struct.pack('<HHHII', 1, datetime_original_tag, 2, 20, 44) + struct.pack('<I', 0)
+        tiff += date.encode('ascii') + b'\x00'
+        app1 = b'Exif\x00\x00' + tiff
+        data += b'\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1
+    data += b'\xff\xda' + struct.pack('>H', 2)
+    data += rng.randbytes(max(0, size - len(data) - 2)).replace(b'\xff', b'\x00') + b'\xff\xd9'
+    return data
+
+
+def make_corpus(storage, files, mean_kb=256, folders=1, seed=0):
+    """
+    Writes a synthetic camera folder: JPEGs with EXIF dates spread over a few years, some named after their date
+    (IMG_YYYYMMDD_hhmmss) and some without EXIF, with log-normal sizes.
+    :param storage: The folder used as the device storage.
+    :param files: The number of files.
+    :param mean_kb: The mean size of the files, in KB.
+    :param folders: The number of subfolders of the camera folder the files are spread in.
+    :param seed: Seed of the random generator, the same seed gives the same corpus.
+    :return: The total size, in bytes.
+    """
+    rng = random.Random(seed)
+    total = 0
+    for n in range(files):
+        folder = os.path.join(storage + phone_dir, f'{n % folders:03d}' if folders > 1 else '')
+        os.makedirs(folder, exist_ok=True)
+        taken = time.localtime(1420070400 + rng.randrange(8 * 365 * 24 * 3600))
+        if n % 20 == 0:
+            date, name = None, f'Screenshot_{n}.jpg'
+        elif n % 3 == 0:
+            date, name = time.strftime('%Y:%m:%d %H:%M:%S', taken), time.strftime(f'IMG_%Y%m%d_%H%M%S_{n}.jpg', taken)
+        else:
+            date, name = time.strftime('%Y:%m:%d %H:%M:%S', taken), f'DSC_{n:06d}.jpg'
+        size = int(rng.lognormvariate(0, 0.5) * mean_kb * 1024 / 1.13)
+        with open(os.path.join(folder, name), 'wb') as f:
+            total += f.write(make_jpeg(date, size, rng))
+    return total
+
+
+@contextlib.contextmanager
+def timed(results, stage):
+    start = time.perf_counter()
+    yield
+    results[stage] = time.perf_counter() - start
+
+
+def run_benchmark(files, work_dir, workers=1, mean_kb=256, folders=1, link_mbps=None, rename=False,
+                  trust_fsync=False):
+    """
+    Backs up a synthetic corpus from a fake device, timing each stage on its own (one after the other, not
+    overlapped as in a real run).
+    :param files: The number of files of the corpus.
+    :param work_dir: Folder where the corpus, the temp and the backup folders are created.
+    :param workers: The number of pull connections.
+    :param mean_kb: The mean size of the files, in KB.
+    :param folders: The number of subfolders of the camera folder.
+    :param link_mbps: Simulated link speed (MB/s), unlimited by default.
+    :param rename: Place the files renaming them (temp and backup folders in the same filesystem) instead of copying.
+    :param trust_fsync: Don't hash the copies again to verify them.
+    :return: Dictionary {stage: seconds, 'files': number of files, 'bytes': total size}
+    """
+    storage = os.path.join(work_dir, 'phone')
+    temp_path = os.path.join(work_dir, 'temp')
+    backup_path = os.path.join(work_dir, 'backup')
+    for path in (storage, temp_path, backup_path):
+        os.makedirs(path)
+    results = {'files': files, 'bytes': make_corpus(storage, files, mean_kb, folders)}
+    transfer.AdbDeviceTcp = fake_device_class(storage, link_mbps)
+    recursive = folders > 1
+
+    with timed(results, 'listing'):
+        device = transfer.connect_device('127.0.0.1', None)
+        listed = list(transfer.list_files(device, phone_dir, recursive=recursive))
+        device.close()
+    with timed(results, 'pull'):
+        pool = transfer.PullPool('127.0.0.1', None, temp_path, workers=workers)
+        for image in listed:
+            pool.put(image)
+        pulled, failed = pool.finish()
+    if failed:
+        raise main.Error(f"{len(failed)} files couldn't be pulled.")
+    with timed(results, 'indexing'):
+        photos = main.get_images(temp_path, ['.jpg'], processes=os.cpu_count())
+
+    # The placement and verification of main.py work on the state of a run, prepared as a real run does (the key is
+    # only checked to exist).
+    adb_key = os.path.join(work_dir, 'adbkey')
+    open(adb_key, 'w').close()
+    config = main.backup_config('127.0.0.1', adb_key, backup_path, phone_dir, temp_dir=temp_path, keep_files=True,
+                                trust_fsync=trust_fsync)
+    devices = main.start_run(config, temp_budget=float('inf'))
+    # Both folders are in the same filesystem, whether the files are renamed is chosen by the benchmark.
+    main.sameDevice = rename
+    with timed(results, 'placement'):
+        moved = [main.place_photo(photo) for photo in photos]
+    with timed(results, 'verification'):
+        for to_verify in moved:
+            if to_verify is not None:
+                main.verify_photo(to_verify)
+    main.finish_run([], devices)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints the times of each stage and their change from the baseline.
+    :param results: Dictionary {number of files: results of run_benchmark}
+    :param baseline: The same, of the reference run (maybe empty).
+    :param threshold: Relative slowdown (e.g. 0.2) reported as a regression.
+    :return: Array of regressions, as strings.
+    """
+    regressions = []
+    for files, result in results.items():
+        reference = baseline.get(str(files), {})
+        print(f"---\n{files} files, {result['bytes'] / 1024 / 1024:.1f} MB")
+        for stage in stages:
+            line = f"{stage:>13}: {result[stage]:8.3f} s {files / result[stage]:10.1f} files/s"
+            if stage == 'pull':
+                line += f" {result['bytes'] / 1024 / 1024 / result[stage]:8.1f} MB/s"
+            if reference.get(stage):
+                change = result[stage] / reference[stage] - 1
+                line += f" ({change:+.0%} from baseline)"
+                if change > threshold:
+                    regressions.append(f"{stage} at {files} files: {change:+.0%}")
+            print(line)
+    return regressions
+
+
+if __name__ == '__main__':
+    benchmark_parser = argparse.ArgumentParser(description='Measures each stage of a backup from a fake device '
+                                                           'serving a synthetic photo corpus.')
+    benchmark_parser.add_argument('--files', help='the sizes of the corpus to measure.', type=int, nargs='+',
+                                  default=[1000, 10000])
+    benchmark_parser.add_argument('--mean_kb', help='the mean size of the files, in KB.', type=int, default=256)
+    benchmark_parser.add_argument('--folders', help='spread the files in this number of subfolders.', type=int,
+                                  default=1)
+    benchmark_parser.add_argument('--workers', help='the number of pull connections.', type=int, default=1)
+    benchmark_parser.add_argument('--link_mbps', help='simulated link speed, in MB/s.', type=float)
+    benchmark_parser.add_argument('--rename', help='place the files renaming them instead of copying.',
+                                  action='store_true')
+    benchmark_parser.add_argument('--trust_fsync', help='don\'t hash the copies again to verify them.',
+                                  action='store_true')
+    benchmark_parser.add_argument('--work_dir', help='where the corpus and the backup are created (a temp folder by '
+                                                     'default, removed at the end).', type=str)
+    benchmark_parser.add_argument('--baseline', help='the file with the results to compare with.', type=str,
+                                  default=os.path.join(os.path.dirname(os.path.abspath(__file__)), baseline_name))
+    benchmark_parser.add_argument('--save_baseline', help='save the results as the new baseline.',
+                                  action='store_true')
+    benchmark_parser.add_argument('--threshold', help='slowdown from the baseline reported as a regression.',
+                                  type=float, default=0.2)
+    benchmark_args = benchmark_parser.parse_args()
+
+    benchmarkResults = {}
+    for fileCount in benchmark_args.files:
+        workDirectory = tempfile.mkdtemp(prefix='jabs_benchmark_', dir=benchmark_args.work_dir)
+        try:
+            # What the backup prints would only slow it down.
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                benchmarkResults[fileCount] = run_benchmark(fileCount, workDirectory, benchmark_args.workers,
+                                                            benchmark_args.mean_kb, benchmark_args.folders,
+                                                            benchmark_args.link_mbps, benchmark_args.rename,
+                                                            benchmark_args.trust_fsync)
+        finally:
+            shutil.rmtree(workDirectory, ignore_errors=True)
+    baselineResults = {}
+    if os.path.exists(benchmark_args.baseline) and not benchmark_args.save_baseline:
+        with open(benchmark_args.baseline, encoding='utf-8') as f:
+            baselineResults = json.load(f)
+    foundRegressions = compare(benchmarkResults, baselineResults, benchmark_args.threshold)
+    if benchmark_args.save_baseline:
+        with open(benchmark_args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({str(files): result for files, result in benchmarkResults.items()}, f, indent=4)
+        print(f"---\nBaseline saved in {benchmark_args.baseline}.")
+    if foundRegressions:
+        print("---\nRegressions:\n" + "\n".join(foundRegressions))
+        sys.exit(1)
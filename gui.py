@@ -1,58 +1,112 @@
-import time
 import wx
 from threading import Thread
-import wx.lib.pubsub as test
+
+import main
+from metrics import run_progress
+
+# The progress is read this number of times per second, however many events the backup sends.
+frame_rate = 10
 
 
 ########################################################################
-class TestThread(Thread):
-    """Test Worker Thread Class."""
+class BackupThread(Thread):
+    """Backup Worker Thread Class."""
 
     # ----------------------------------------------------------------------
-    def __init__(self):
+    def __init__(self, config):
         """Init Worker Thread Class."""
-        Thread.__init__(self)
+        Thread.__init__(self, daemon=True)
+        self.config = config
+        self.result = None
+        self.error = None
         self.start()  # start the thread
 
     # ----------------------------------------------------------------------
     def run(self):
         """Run Worker Thread."""
-        # This is the code executing in the new thread.
-        for i in range(20):
-            time.sleep(1)
-            wx.CallAfter(test.pub().sendMessage, "update", "")
+        # This is the code executing in the new thread. It never touches the UI, the progress goes through
+        # run_progress and the dialog polls it.
+        try:
+            self.result = main.backup(self.config)
+        except main.Error as e:
+            self.error = e.message
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
 
 
 ########################################################################
-class MyProgressDialog(wx.Dialog):
-    """"""
+class BackupProgressDialog(wx.Dialog):
+    """Progress of a backup, refreshed frame_rate times per second."""
 
     # ----------------------------------------------------------------------
-    def __init__(self):
+    def __init__(self, config):
         """Constructor"""
-        wx.Dialog.__init__(self, None, title="Progress")
-        self.count = 0
-
-        self.progress = wx.Gauge(self, range=20)
+        wx.Dialog.__init__(self, None, title="Backup")
+        self.progress = wx.Gauge(self, range=1)
+        self.stagesText = wx.StaticText(self, label="Starting...")
+        self.filesText = wx.StaticText(self, label="")
+        self.transferText = wx.StaticText(self, label="")
+        self.log = wx.TextCtrl(self, style=wx.TE_MULTILINE | wx.TE_READONLY, size=(480, 120))
+        self.closeBtn = wx.Button(self, wx.ID_CLOSE, label="Close")
+        self.closeBtn.Disable()
+        self.closeBtn.Bind(wx.EVT_BUTTON, lambda event: self.EndModal(wx.ID_CLOSE))
 
         sizer = wx.BoxSizer(wx.VERTICAL)
-        sizer.Add(self.progress, 0, wx.EXPAND)
-        self.SetSizer(sizer)
-
-        # create a pubsub listener
-        test.pub().subscribe(self.updateProgress, "update")
+        sizer.Add(self.progress, 0, wx.EXPAND | wx.ALL, 5)
+        for widget in [self.stagesText, self.filesText, self.transferText]:
+            sizer.Add(widget, 0, wx.EXPAND | wx.LEFT | wx.RIGHT, 5)
+        sizer.Add(self.log, 1, wx.EXPAND | wx.ALL, 5)
+        sizer.Add(self.closeBtn, 0, wx.ALL | wx.CENTER, 5)
+        self.SetSizerAndFit(sizer)
+
+        self.worker = BackupThread(config)
+        # The UI polls the progress at a fixed rate instead of getting a call for every event.
+        self.timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.updateProgress, self.timer)
+        self.timer.Start(1000 // frame_rate)
+        self.Bind(wx.EVT_CLOSE, self.onClose)
 
     # ----------------------------------------------------------------------
-    def updateProgress(self, msg):
+    def onClose(self, event):
         """
-        Update the progress bar
+        The dialog can't be closed while the backup runs
         """
-        self.count += 1
-
-        if self.count >= 20:
-            self.Destroy()
+        if self.worker.is_alive() and event.CanVeto():
+            event.Veto()
+            return
+        self.timer.Stop()
+        event.Skip()
 
-        self.progress.SetValue(self.count)
+    # ----------------------------------------------------------------------
+    def updateProgress(self, event):
+        """
+        Update the progress bar and texts with everything that happened since the last frame
+        """
+        snapshot = run_progress.poll()
+        counters = snapshot['counters']
+        finished = counters.get('copied', 0) + counters.get('duplicates', 0) + counters.get('failed', 0)
+        self.progress.SetRange(max(1, counters.get('listed', 0)))
+        self.progress.SetValue(min(finished, self.progress.GetRange()))
+        self.stagesText.SetLabel(", ".join(f"{source}: {stage}" for source, stage in snapshot['stages'].items()))
+        self.filesText.SetLabel(f"{counters.get('pulled', 0)} files pulled "
+                                f"({counters.get('pulled_bytes', 0) / 1024 / 1024:.1f} MB), "
+                                f"{counters.get('copied', 0)} copied, {counters.get('duplicates', 0)} already in the "
+                                f"backup, {counters.get('failed', 0)} failed.")
+        self.transferText.SetLabel("\n".join(f"{name}: {done * 100 // total}%"
+                                             for name, (done, total) in list(snapshot['transfers'].items())[:3]
+                                             if total))
+        for message in snapshot['messages']:
+            self.log.AppendText(message + "\n")
+
+        if not self.worker.is_alive():
+            self.timer.Stop()
+            if self.worker.error is not None:
+                self.log.AppendText(f"The backup couldn't be done: {self.worker.error}\n")
+            else:
+                result = self.worker.result
+                self.log.AppendText(f"All done! {result.copied} files copied, {result.duplicates} already in the "
+                                    f"backup and {result.failed} failed.\n")
+            self.closeBtn.Enable()
 
 
 ########################################################################
@@ -60,28 +114,47 @@ class MyFrame(wx.Frame):
 
     # ----------------------------------------------------------------------
     def __init__(self):
-        wx.Frame.__init__(self, None, title="Progress Bar Tutorial")
+        wx.Frame.__init__(self, None, title="JABS")
 
         # Add a panel so it looks the correct on all platforms
         panel = wx.Panel(self, wx.ID_ANY)
-        self.btn = btn = wx.Button(panel, label="Start Thread")
+        self.fields = {}
+        grid = wx.FlexGridSizer(cols=2, vgap=5, hgap=5)
+        for key, label in [('phone_ip', "Phone IP (or devices file)"), ('adb_key', "ADB key"),
+                           ('backup_dir', "Backup folder"), ('phone_dir', "Phone folder")]:
+            grid.Add(wx.StaticText(panel, label=label), 0, wx.ALIGN_CENTER_VERTICAL)
+            self.fields[key] = wx.TextCtrl(panel, size=(300, -1))
+            grid.Add(self.fields[key], 1, wx.EXPAND)
+        self.fields['phone_dir'].SetValue("/storage/emulated/0/DCIM/Camera/")
+        self.keepFiles = wx.CheckBox(panel, label="Keep the files on the phone")
+        self.btn = btn = wx.Button(panel, label="Start backup")
         btn.Bind(wx.EVT_BUTTON, self.onButton)
 
         sizer = wx.BoxSizer(wx.VERTICAL)
+        sizer.Add(grid, 0, wx.ALL | wx.EXPAND, 5)
+        sizer.Add(self.keepFiles, 0, wx.ALL, 5)
         sizer.Add(btn, 0, wx.ALL | wx.CENTER, 5)
-        panel.SetSizer(sizer)
+        panel.SetSizerAndFit(sizer)
+        self.Fit()
 
     # ----------------------------------------------------------------------
     def onButton(self, event):
         """
-        Runs the thread
+        Runs the backup
         """
+        try:
+            config = main.backup_config(*[self.fields[key].GetValue().strip()
+                                          for key in ['phone_ip', 'adb_key', 'backup_dir', 'phone_dir']],
+                                        keep_files=self.keepFiles.GetValue())
+        except main.Error as e:
+            wx.MessageBox(e.message, "JABS", wx.OK | wx.ICON_ERROR)
+            return
         btn = event.GetEventObject()
         btn.Disable()
 
-        TestThread()
-        dlg = MyProgressDialog()
+        dlg = BackupProgressDialog(config)
         dlg.ShowModal()
+        dlg.Destroy()
 
         btn.Enable()
 
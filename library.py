@@ -0,0 +1,384 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+chunk_size = 1024 * 1024
+# Separates the route of a pack from the name of a file in it (see packs.DailyPacks).
+member_separator = '::'
+
+
+class DateIndex(object):
+    """
+    In-memory index of the year/month/day folders of the backup directory.
+    It's built once per run (or loaded from disk) and updated in place when new folders are created, so looking for
+    the destination of a photo doesn't need to walk the whole backup tree.
+    """
+
+    index_name = '.jabs_index.json'
+
+    def __init__(self, home_path):
+        super(DateIndex, self).__init__()
+        self.home_path = home_path
+        # {year: {month: set(days)}}, all of them as folder names (str).
+        self.years = {}
+        # Several placement threads can create folders at the same time.
+        self.lock = threading.RLock()
+
+    # Walks only the three levels of the backup structure, ignoring files.
+    def build(self):
+        self.years = {}
+        for year in _subdirectories(self.home_path):
+            months = self.years.setdefault(year, {})
+            for month in _subdirectories(os.path.join(self.home_path, year)):
+                months[month] = set(_subdirectories(os.path.join(self.home_path, year, month)))
+        return self
+
+    # Checks for the existence of the Y, M and D folders. Returns array of booleans.
+    def search(self, year, month, day):
+        months = self.years.get(str(year))
+        if months is None:
+            return [False, False, False]
+        days = months.get(str(month))
+        if days is None:
+            return [True, False, False]
+        return [True, True, str(day) in days]
+
+    # Returns the path of the day folder, creating it if it doesn't exist (the saved index may be stale, e.g. after
+    # moving folders off the backup drive, so the folder is always checked).
+    def ensure(self, year, month, day):
+        year, month, day = str(year), str(month), str(day)
+        path = os.path.join(self.home_path, year, month, day)
+        with self.lock:
+            os.makedirs(path, exist_ok=True)
+            if not self.search(year, month, day)[2]:
+                self.years.setdefault(year, {}).setdefault(month, set()).add(day)
+                self.save()
+        return path
+
+    def save(self, index_file=None):
+        """
+        Saves the index to disk. The file is replaced atomically, so a crash never leaves a half-written index.
+        :param index_file: The file where the index is stored. By default, inside the backup directory.
+        :return: The path of the saved index.
+        """
+        index_file = index_file or os.path.join(self.home_path, self.index_name)
+        with self.lock:
+            to_save = {y: {m: sorted(d) for m, d in months.items()} for y, months in self.years.items()}
+            with open(index_file + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(to_save, f)
+            os.replace(index_file + '.tmp', index_file)
+        return index_file
+
+    @classmethod
+    def load(cls, home_path, index_file=None, rebuild=False):
+        """
+        Loads the index of the given backup directory, walking it only if there's no saved (valid) index.
+        :param home_path: The backup directory.
+        :param index_file: The file where the index is stored. By default, inside the backup directory.
+        :param rebuild: Ignore any saved index and walk the backup directory.
+        :return: DateIndex
+        """
+        date_index = cls(home_path)
+        index_file = index_file or os.path.join(home_path, cls.index_name)
+        if not rebuild and os.path.isfile(index_file):
+            try:
+                with open(index_file, encoding='utf-8') as f:
+                    saved = json.load(f)
+                date_index.years = {y: {m: set(d) for m, d in months.items()} for y, months in saved.items()}
+                return date_index
+            except (ValueError, AttributeError):
+                pass
+        date_index.build()
+        date_index.save(index_file)
+        return date_index
+
+
+class Database(object):
+    """
+    SQLite database of the backup folder, shared by the threads of the pipeline.
+    Writes are committed in batches; close() commits the last ones.
+    """
+
+    def __init__(self, database_file, schema, commit_every=50):
+        super(Database, self).__init__()
+        self.database_file = database_file
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.database_file, check_same_thread=False)
+        self.connection.execute(schema)
+        self.connection.commit()
+
+    def query(self, sql, parameters=()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def write(self, sql, parameters=()):
+        with self.lock:
+            self.connection.execute(sql, parameters)
+            self.uncommitted += 1
+            if self.uncommitted >= self.commit_every:
+                self.connection.commit()
+                self.uncommitted = 0
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+
+class SyncManifest(Database):
+    """
+    Record of the files already pulled from each device, keyed by remote path, size and modification time.
+    It's stored as a SQLite database so that a new listing of the device can be diffed against it and only the new
+    or changed files are transferred.
+    """
+
+    manifest_name = '.jabs_sync.db'
+
+    def __init__(self, home_path, manifest_file=None, commit_every=50):
+        super(SyncManifest, self).__init__(manifest_file or os.path.join(home_path, self.manifest_name),
+                                           'CREATE TABLE IF NOT EXISTS pulled (device TEXT, path TEXT, size INTEGER, '
+                                           'mtime INTEGER, PRIMARY KEY (device, path))', commit_every)
+
+    # Returns {remote path: (size, mtime)} of the files already pulled from the device.
+    def pulled(self, device):
+        rows = self.query('SELECT path, size, mtime FROM pulled WHERE device = ?', (device,))
+        return {path: (size, mtime) for path, size, mtime in rows}
+
+    def add(self, device, image):
+        self.write('INSERT OR REPLACE INTO pulled VALUES (?, ?, ?, ?)',
+                   (device, image.path + image.name, image.size, image.mtime))
+
+
+class HashIndex(Database):
+    """
+    Content-addressed index of the backup folder (hash -> stored file), used to find out if a file is already backed
+    up whatever its name or date folder. The paths are stored relative to the backup folder.
+    """
+
+    index_name = '.jabs_hashes.db'
+
+    def __init__(self, home_path, index_file=None, commit_every=50):
+        super(HashIndex, self).__init__(index_file or os.path.join(home_path, self.index_name),
+                                        'CREATE TABLE IF NOT EXISTS stored (hash TEXT PRIMARY KEY, path TEXT)',
+                                        commit_every)
+        self.home_path = home_path
+
+    # Returns the route of the stored file with the given hash, or None.
+    def get(self, file_hash):
+        rows = self.query('SELECT path FROM stored WHERE hash = ?', (file_hash,))
+        if not rows:
+            return None
+        stored_f = os.path.join(self.home_path, rows[0][0])
+        # The file may have been removed from the backup by hand.
+        if not os.path.exists(stored_f.split(member_separator, 1)[0]):
+            self.write('DELETE FROM stored WHERE hash = ?', (file_hash,))
+            return None
+        return stored_f
+
+    def add(self, file_hash, stored_f):
+        self.write('INSERT OR REPLACE INTO stored VALUES (?, ?)',
+                   (file_hash, os.path.relpath(stored_f, self.home_path)))
+
+
+class DeletionQueue(Database):
+    """
+    Files that can be removed from their device because they're already (verified) in the backup folder.
+    It's kept on disk and every file is committed as soon as it's added, so a crash never loses track of what's safe
+    to delete. The files are removed in batches at the end of the run.
+    """
+
+    queue_name = '.jabs_delete.db'
+
+    def __init__(self, home_path, queue_file=None):
+        super(DeletionQueue, self).__init__(queue_file or os.path.join(home_path, self.queue_name),
+                                            'CREATE TABLE IF NOT EXISTS to_delete (device TEXT, path TEXT, '
+                                            'PRIMARY KEY (device, path))', commit_every=1)
+
+    # Returns the remote routes waiting to be removed from the device.
+    def pending(self, device):
+        return [row[0] for row in self.query('SELECT path FROM to_delete WHERE device = ?', (device,))]
+
+    def add(self, device, path):
+        self.write('INSERT OR REPLACE INTO to_delete VALUES (?, ?)', (device, path))
+
+    # Forgets the given routes once they're removed from the device.
+    def remove(self, device, paths):
+        with self.lock:
+            self.connection.executemany('DELETE FROM to_delete WHERE device = ? AND path = ?',
+                                        [(device, path) for path in paths])
+            self.connection.commit()
+
+
+class RunManifest(object):
+    """
+    Record of what a run did with each file (JSON Lines, append-only), written while the run goes on.
+    Records are flushed in batches (or after a few seconds), so a killed run loses at most the last batch and every
+    line already written can be read back.
+    """
+
+    def __init__(self, manifest_file, flush_every=50, flush_after_s=5.):
+        super(RunManifest, self).__init__()
+        self.manifest_file = manifest_file
+        self.flush_every = flush_every
+        self.flush_after_s = flush_after_s
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+        # Number of records of each status.
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.file = open(manifest_file, 'a', encoding='utf-8')
+
+    def record(self, status, **fields):
+        """
+        Adds the record of a file.
+        :param status: What was done with the file (e.g. copied, duplicate or failed).
+        :param fields: The rest of the record, JSON-serializable values.
+        :return: The number of records with the same status, including this one.
+        """
+        fields['status'] = status
+        fields['time'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        line = json.dumps(fields, ensure_ascii=False) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.counts[status] = self.counts.get(status, 0) + 1
+            self.unflushed += 1
+            if self.unflushed >= self.flush_every or time.monotonic() - self.last_flush >= self.flush_after_s:
+                self.flush()
+            return self.counts[status]
+
+    def flush(self):
+        self.file.flush()
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_run_manifests(manifest_files, date=None, file_hash=None, device=None):
+    """
+    Reads the records of one or more run manifests, optionally filtered. A line cut by a crash is skipped.
+    :param manifest_files: Array of routes of manifests.
+    :param date: Only the files taken on this date, or on any date starting like this (e.g. 2021-03).
+    :param file_hash: Only the files with this hash.
+    :param device: Only the files pulled from this device (serial number or IP).
+    :return: Generator of records (dictionaries).
+    """
+    for manifest_file in manifest_files:
+        with open(manifest_file, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if date is not None and not (record.get('date') or '').startswith(date):
+                    continue
+                if file_hash is not None and record.get('hash') != file_hash:
+                    continue
+                if device is not None and record.get('device') != device:
+                    continue
+                yield record
+
+
+def hash_file(path):
+    """
+    Gets the SHA-256 hash of a file, reading it in chunks.
+    :param path: The route of the file.
+    :return: The hash as an hex string.
+    """
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def copy_hashed(original_f, backup_dir, name=None):
+    """
+    Copies a file (data and metadata, like shutil.copy2) hashing it while it's read, so the original is read only
+    once. The copy is fsync'd before returning.
+    :param original_f: The route of the file to copy.
+    :param backup_dir: The folder where the file is copied.
+    :param name: The name of the copy. By default, the same of the original.
+    :return: Array [route of the copy, SHA-256 hash of the original]
+    """
+    copy_f = os.path.join(backup_dir, name or os.path.basename(original_f))
+    file_hash = hashlib.sha256()
+    with open(original_f, 'rb') as f_in, open(copy_f, 'wb') as f_out:
+        for chunk in iter(lambda: f_in.read(chunk_size), b''):
+            file_hash.update(chunk)
+            f_out.write(chunk)
+        f_out.flush()
+        os.fsync(f_out.fileno())
+    shutil.copystat(original_f, copy_f)
+    return [copy_f, file_hash.hexdigest()]
+
+
+def same_device(path_a, path_b):
+    """
+    Checks if two paths are in the same filesystem (so a file can be renamed from one to the other).
+    :return: Boolean
+    """
+    return os.stat(path_a).st_dev == os.stat(path_b).st_dev
+
+
+def move_atomic(original_f, backup_dir, name=None):
+    """
+    Moves a file to a folder of the same filesystem with a rename, so only metadata is written. The file (which may
+    not have been fsync'd when it was written, e.g. by adb pull) and both folders are fsync'd so the move survives a
+    power loss.
+    :param original_f: The route of the file to move.
+    :param backup_dir: The folder where the file is moved.
+    :param name: The final name of the file. By default, the same of the original.
+    :return: The final route of the file.
+    """
+    moved_f = os.path.join(backup_dir, name or os.path.basename(original_f))
+    # Opened for writing, Windows doesn't flush read-only handles.
+    with open(original_f, 'r+b') as f:
+        os.fsync(f.fileno())
+    os.rename(original_f, moved_f)
+    fsync_directory(backup_dir)
+    fsync_directory(os.path.dirname(original_f))
+    return moved_f
+
+
+def fsync_directory(path):
+    # Directories can't be opened (nor fsync'd) on Windows, there the rename is already durable.
+    if os.name == 'nt':
+        return
+    fd = os.open(path or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def unique_name(name, file_hash):
+    """
+    Gets a name for a file whose name is already taken by a different file. It depends only on the content, so the
+    same file always gets the same name.
+    :param name: The original name.
+    :param file_hash: The hash of the file.
+    :return: The new name.
+    """
+    return os.path.splitext(name)[0] + "_" + file_hash[:8] + os.path.splitext(name)[1]
+
+
+def _subdirectories(path):
+    try:
+        with os.scandir(path) as entries:
+            return [entry.name for entry in entries if entry.is_dir()]
+    except FileNotFoundError:
+        return []
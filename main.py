@@ -1,16 +1,18 @@
 import argparse
-import filecmp
 import json
 import os
-import random
 import re
-import shutil
-import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-from adb_shell.adb_device import AdbDeviceTcp
-from adb_shell.auth.sign_pythonrsa import PythonRSASigner
-from exif import Image
+from library import (DateIndex, DeletionQueue, HashIndex, RunManifest, SyncManifest, copy_hashed, hash_file,
+                     move_atomic, read_run_manifests, same_device, unique_name)
+from metadata import media_suffixes, read_file_info, read_files_info
+from metrics import Progress, RunProfiler, run_metrics, run_progress
+from packs import DailyPacks
+from pipeline import ByteBudget, RateLimiter, Stage, done, new_queue
 
 
 class Error(Exception):
@@ -24,14 +26,58 @@ def validate_ip_form(ip_string):
     return ip_string
 
 
+def validate_device_form(device_string):
+    # Either the IP of a device or a file listing several devices.
+    if os.path.isfile(device_string):
+        return device_string
+    return validate_ip_form(device_string)
+
+
+def load_devices(devices_file, adb_key_file, phone_dir):
+    """
+    Reads the list of devices to backup, a JSON file like [{"ip": ..., "key": ..., "folders": [...]}, ...].
+    The key and the folders can be left out, the ones given in the command line are used then.
+    :param devices_file: The route of the file.
+    :param adb_key_file: The ADB key used when a device doesn't have one.
+    :param phone_dir: The folder backed up when a device doesn't have any.
+    :return: Array of [IP, ADB key, array of folders]
+    """
+    with open(devices_file, encoding='utf-8') as f:
+        listed = json.load(f)
+    devices = []
+    for device in listed:
+        try:
+            remote_ip = validate_ip_form(device['ip'])
+        except (KeyError, argparse.ArgumentTypeError):
+            raise Error(f"Wrong device in {devices_file}: {device}")
+        adb_key = os.path.normpath(device.get('key', adb_key_file))
+        if not os.path.exists(adb_key):
+            raise Error(f"The ADB key of {remote_ip} was not found.")
+        folders = [folder.replace("\\", "/") for folder in device.get('folders', [phone_dir])]
+        devices.append([remote_ip, adb_key, folders])
+    return devices
+
+
 use_profile = False
 backup_parser = None
+# Below this number of files, starting the processes takes longer than indexing them one by one.
+min_parallel_index = 500
+# Files hashed on the device with each sha256sum command.
+hash_batch = 200
+# Files up to this size are pulled in tar batches of this number of files.
+tar_max_size = 1024 * 1024
+tar_batch = 500
+# Folder of the backup where near-duplicates are moved with --near_duplicates quarantine.
+quarantine_name = 'near_duplicates'
+# Pull progress is printed at most twice per second.
+pull_progress = Progress(0.5)
 
 if not use_profile:
     backup_parser = argparse.ArgumentParser(description='Performs the backup of a specific phone directory to another '
                                                         'specified directory.')
-    backup_parser.add_argument('phone_ip', help='the IP of the device from which get the files to backup.',
-                               type=validate_ip_form, metavar='phone_IP')
+    backup_parser.add_argument('phone_ip', help='the IP of the device from which get the files to backup, or a JSON '
+                                                'file listing several devices to backup at the same time.',
+                               type=validate_device_form, metavar='phone_IP')
     backup_parser.add_argument('adb_key', help='the path were the ADB key of the specific Android device is stored.',
                                metavar='ADB_key', type=str)
     backup_parser.add_argument('backup_dir', help='the backup path of the folder in which the backup will be done.',
@@ -42,490 +88,1253 @@ if not use_profile:
                                                   'device will be stored.', type=str)
     backup_parser.add_argument('--max_android_files', help='specify the maximum number of files to backup.',
                                type=int)
-
-args = backup_parser.parse_args()
-
-# Defined values.
-# Android-related paths.
-phone_ip = args.phone_ip
-adbkey_route = args.adb_key.replace("/", "\\")
-# Last bar is important. Bar position is important.
-android_path = args.phone_dir.replace("\\", "/")
-# Final-backup related paths.
-max_android_files = args.max_android_files or None
-# Dependent-value for function.
-bckpPath = args.backup_dir.replace("/", "\\")
-# Dependent-value for function.
-if args.temp_dir:
-    temp_directory = args.temp_dir.replace("/", "\\")
-else:
-    temp_directory = os.path.join(os.path.split(bckpPath)[0], 'jabs_tmp')
-# Check and prepare paths.
-if not os.path.exists(adbkey_route):
-    raise Error("The specified ADB key was not found.")
-for path in [bckpPath, temp_directory]:
-    if not os.path.exists(path):
-        os.makedirs(path)
-
+    backup_parser.add_argument('--workers', help='the number of simultaneous connections used to pull the files.',
+                               type=int, default=1)
+    backup_parser.add_argument('--keep_files', help='don\'t remove the files from the device once they\'re backed up.',
+                               action='store_true')
+    backup_parser.add_argument('--temp_budget', help='the maximum MB of pulled files waiting in the temp directory.',
+                               type=int, default=512)
+    backup_parser.add_argument('--trust_fsync', help='don\'t read the copies again to check their hash.',
+                               action='store_true')
+    backup_parser.add_argument('--duplicates', help='what to do with files already in the backup: skip them or add a '
+                                                    'hard link to the stored file in their day folder.',
+                               choices=['skip', 'link'], default='skip')
+    backup_parser.add_argument('--device_hash', help='hash the files on the device (sha256sum) to skip those already '
+                                                     'backed up and check the pulled ones.', action='store_true')
+    backup_parser.add_argument('--recursive', help='backup also the subfolders of the phone folder.',
+                               action='store_true')
+    backup_parser.add_argument('--tar', help='pull the small files in batches, streamed by tar from the device '
+                                             '(Android 7 or higher).', action='store_true')
+    backup_parser.add_argument('--resume', help='continue a killed backup, pulling the files it left without listing '
+                                                'the phone folder again.', action='store_true')
+    backup_parser.add_argument('--max_rate', help='the maximum MB/s pulled from all the devices together.',
+                               type=float)
+    backup_parser.add_argument('--disk_writers', help='the number of files written to the backup folder at the same '
+                                                      'time.', type=int, default=1)
+    backup_parser.add_argument('--daemon', help='keep running and backup each device as soon as it appears on the '
+                                                'network, keeping its ADB connections open.', action='store_true')
+    backup_parser.add_argument('--probe_interval', help='the seconds between two checks of the devices, as daemon.',
+                               type=float, default=30)
+    backup_parser.add_argument('--near_duplicates', help='look for photos of the backup that look the same as the new '
+                                                         'ones (needs NumPy and Pillow) and report them in the run '
+                                                         'manifest or move the new ones to a quarantine folder.',
+                               choices=['report', 'quarantine'])
+    backup_parser.add_argument('--near_distance', help='the maximum number of different bits (of 64) of two photos '
+                                                       'that look the same.', type=int, default=6)
+    backup_parser.add_argument('--metrics_json', help='save the time and throughput of each stage to this JSON file.',
+                               type=str)
+    backup_parser.add_argument('--metrics_prom', help='save the metrics to this file in the Prometheus text format '
+                                                      '(updated at every check, as daemon).', type=str)
+    backup_parser.add_argument('--profile', help='profile the run (cProfile) and save the stats to this file.',
+                               type=str)
+    backup_parser.add_argument('--packs', help='append the files of each day to a single tar file (year/month/day.tar) '
+                                               'instead of writing them one by one, for slow drives. They can be '
+                                               'listed and extracted with packs.py.', action='store_true')
+    backup_parser.add_argument('--dry_run', help='only list the files that would be pulled from the devices.',
+                               action='store_true')
+    backup_parser.add_argument('--reindex', help='ignore the saved index of the backup folder and walk it again.',
+                               action='store_true')
 
 # Date object for images.
 class Date(object):
-    """docstring for Date."""
+    """
+    Date of an image, packed in a single integer (YYYYMMDDhhmmss) so that millions of them fit in memory.
+    """
+
+    __slots__ = ('stamp',)
 
     # Initialization of Date
-    def __init__(self):
+    def __init__(self, stamp=None):
         super(Date, self).__init__()
-        self.year = None
-        self.day = None
-        self.month = None
-        self.hour = None
-        self.minute = None
-        self.second = None
+        self.stamp = stamp
+
+    @property
+    def year(self):
+        return self.unpack(self.stamp)[0]
+
+    @property
+    def month(self):
+        return self.unpack(self.stamp)[1]
+
+    @property
+    def day(self):
+        return self.unpack(self.stamp)[2]
+
+    @property
+    def hour(self):
+        return self.unpack(self.stamp)[3]
+
+    @property
+    def minute(self):
+        return self.unpack(self.stamp)[4]
+
+    @property
+    def second(self):
+        return self.unpack(self.stamp)[5]
 
     # Methods for Date
     # Checks is Date objects has been initialized, return array of boolean.
     def is_initialized(self):
-        y = False
-        mo = False
-        d = False
-        h = False
-        min = False
-        s = False
-        if self.year is not None:
-            y = True
-        if self.month is not None:
-            mo = True
-        if self.day is not None:
-            d = True
-        if self.hour is not None:
-            h = True
-        if self.minute is not None:
-            min = True
-        if self.second is not None:
-            s = True
-        if y and mo and d and h and min and s:
-            return [True, y, mo, d, h, min, s]
-        else:
-            return [False, y, mo, d, h, min, s]
+        initialized = self.stamp is not None
+        return [initialized] * 7
 
     # Covert a given string with format YYYYMMDDhhmmss
     def covert_continue(self, initial_str):
+        stamp = self.pack(initial_str)
+        if stamp is not None:
+            self.stamp = stamp
+
+    @staticmethod
+    def pack(initial_str):
+        """
+        Packs a string with format YYYYMMDDhhmmss.
+        :param initial_str: The date.
+        :return: The packed date (int), or None if it's not a possible date.
+        """
+        # E.g. a blank EXIF date ("    :  :     :  :  ") has no digits at all.
+        if len(initial_str) != 14 or not initial_str.isdigit():
+            return None
         # Checks possible date according to physics.
         if (int(initial_str[4:6]) <= 12) and (int(initial_str[6:8]) <= 31):
-            self.year = int(initial_str[0:4])
-            self.month = int(initial_str[4:6])
-            self.day = int(initial_str[6:8])
-            self.hour = int(initial_str[8:10])
-            self.minute = int(initial_str[10:12])
-            self.second = int(initial_str[12:14])
-
-    # COPY PASTE STACKOVERFLOW
-    def to_JSON(self):
-        return json.dumps(self, default=lambda o: o.__dict__,
-                          sort_keys=True, indent=4)
-
+            stamp = int(initial_str[0:4])
+            for start in range(4, 14, 2):
+                stamp = stamp * 100 + int(initial_str[start:start + 2])
+            return stamp
+        return None
 
-# Object for reduced info. files.
-class AndroidPhoto(object):
-    """docstring for androidPhoto."""
+    # Returns tuple (year, month, day, hour, minute, second) of a packed date.
+    @staticmethod
+    def unpack(stamp):
+        if stamp is None:
+            return None, None, None, None, None, None
+        stamp, second = divmod(stamp, 100)
+        stamp, minute = divmod(stamp, 100)
+        stamp, hour = divmod(stamp, 100)
+        stamp, day = divmod(stamp, 100)
+        year, month = divmod(stamp, 100)
+        return year, month, day, hour, minute, second
 
-    def __init__(self):
-        super(AndroidPhoto, self).__init__()
-        self.name = None
-        self.path = None
-        self.size = None
+    def to_JSON(self):
+        return json.dumps(self.stamp)
 
 
 # Object for the backup items
 class Photo(object):
-    """docstring for Photo."""
+    """
+    File to backup, with its dates (from the EXIF, the title and the directory) packed as integers.
+    The date used to place the file is resolved once (on first use) and cached.
+    """
+
+    __slots__ = ('directory', 'name', 'size', 'cstamp', 'tstamp', 'dstamp', 'hash', 'device', 'remote', '_resolved')
 
     # Initialization of Photo
     def __init__(self):
         super(Photo, self).__init__()
         self.directory = None
         self.name = None
-        self.ddate = Date()
         self.size = None
-        # Title
-        self.tdate = Date()
-        # EXIF #
-        self.cdate = Date()
+        # EXIF, title and directory dates, packed (see Date).
+        self.cstamp = None
+        self.tstamp = None
+        self.dstamp = None
+        # SHA-256 hash of the file, the same given by sha256sum on the device.
+        self.hash = None
+        # Device and route where the file was pulled from.
+        self.device = None
+        self.remote = None
+        self._resolved = None
 
     # Methods for Photo
+    @property
+    def cdate(self):
+        return Date(self.cstamp)
+
+    @property
+    def tdate(self):
+        return Date(self.tstamp)
+
+    @property
+    def ddate(self):
+        return Date(self.dstamp)
+
     # Checks existence of directory date. Return boolean.
     def is_ddate(self):
-        if self.ddate.is_initialized()[0]:
-            return True
-        else:
-            return False
+        return self.dstamp is not None
 
     # Checks existence of title date. Return boolean.
     def is_tdate(self):
-        if self.tdate.is_initialized()[0]:
-            return True
-        else:
-            return False
+        return self.tstamp is not None
 
     # Checks for creation (exif) date. Returns boolean.
     def is_cdate(self):
-        if self.cdate.is_initialized()[0]:
-            return True
-        else:
-            return False
+        return self.cstamp is not None
+
+    # Returns tuple (year, month, day, hour, minute, second), each one in order of preference c - t - d.
+    def resolve(self):
+        if self._resolved is None:
+            dates = [Date.unpack(self.cstamp), Date.unpack(self.tstamp), Date.unpack(self.dstamp)]
+            resolved = [c or t or d or 0 for c, t, d in zip(*dates)]
+            # Packed as well, 0 if there's no date at all.
+            self._resolved = resolved[0] * 10000000000 + int("".join(f"{n:02d}" for n in resolved[1:]))
+        return tuple(n or None for n in Date.unpack(self._resolved))
 
     # Returns year (order preference: c - t - d)
     def get_year(self):
-        return self.cdate.year or self.tdate.year or self.ddate.year or None
+        return self.resolve()[0]
 
     # Returns month (order of preference c - t -d)
     def get_month(self):
-        return self.cdate.month or self.tdate.month or self.ddate.month or None
+        return self.resolve()[1]
 
     # Returns day (order of preference c - t - d)
     def get_day(self):
-        return self.cdate.day or self.tdate.day or self.ddate.day or None
+        return self.resolve()[2]
 
     # Returns hour (order of preference c - t - d)
     def get_hour(self):
-        return self.cdate.hour or self.tdate.hour or self.ddate.hour or None
+        return self.resolve()[3]
 
     # Returns minute (order of preference c - t - d)
     def get_minute(self):
-        return self.cdate.minute or self.tdate.minute or self.ddate.minute or None
+        return self.resolve()[4]
 
     # Returns second (order of preference c - t - d)
     def get_second(self):
-        return self.cdate.second or self.tdate.second or self.ddate.second or None
+        return self.resolve()[5]
+
+    # Returns the date (ISO format, order of preference c - t - d), or None.
+    def get_date(self):
+        year, month, day, hour, minute, second = self.resolve()
+        if year is None:
+            return None
+        return f"{year:04d}-{month:02d}-{day:02d}T{hour or 0:02d}:{minute or 0:02d}:{second or 0:02d}"
 
     # Get image format
     def get_image_format(self):
         return os.path.splitext(self.name)[1]
 
-    ##COPY PASTE STACKOVERFLOW
+    # Returns the fields of the photo kept in the run manifest.
+    def to_record(self):
+        return {'name': self.name, 'size': self.size, 'hash': self.hash, 'date': self.get_date(),
+                'cdate': self.cstamp, 'tdate': self.tstamp, 'ddate': self.dstamp, 'device': self.device,
+                'remote': self.remote}
+
+    @classmethod
+    def from_record(cls, record):
+        """
+        Builds a photo from its record in a run manifest, placed where the run left it.
+        :param record: Dictionary, as written by to_record.
+        :return: Photo-type object.
+        """
+        photo = cls()
+        if record.get('destination'):
+            photo.directory, photo.name = os.path.split(record['destination'])
+        else:
+            photo.name = record.get('name')
+        photo.size = record.get('size')
+        photo.cstamp = record.get('cdate')
+        photo.tstamp = record.get('tdate')
+        photo.dstamp = record.get('ddate')
+        photo.hash = record.get('hash')
+        photo.device = record.get('device')
+        photo.remote = record.get('remote')
+        return photo
+
     def toJSON(self):
-        return json.dumps(self, default=lambda o: o.__dict__,
-                          sort_keys=True, indent=4)
+        return json.dumps(self.to_record(), sort_keys=True, indent=4)
+
+
+def load_photos(manifest_files, **filters):
+    """
+    Loads the photos recorded in run manifests (see read_run_manifests for the filters).
+    :param manifest_files: Array of routes of manifests.
+    :return: Array of Photo-type objects.
+    """
+    return [Photo.from_record(record) for record in read_run_manifests(manifest_files, **filters)]
 
 
-def get_images(original_directory, suffixes, photos_per_move=None):
+def get_images(original_directory, suffixes, photos_per_move=None, processes=None, on_error=None):
     """
     Scans a given directory searching for the given suffixes files (indexing looks like the most time-consuming action).
     :param original_directory: The original path where the images are located.
     :param suffixes: The suffixes of the files to be moved.
     :param photos_per_move: Number of files to move.
+    :param processes: If given, big directories are indexed with a pool of this number of processes.
+    :param on_error: If given, called with the Photo (without dates) and the error of each file that can't be indexed,
+    which is left out. Otherwise, the error is raised.
     :return: An array of Photo-type objects.
     """
-    p_count = 0
-    images_array = []
+    to_index = []
     for root, dirs, files in os.walk(original_directory):
         for file in files:
-            for end in suffixes:
-                if file.endswith(end):
-                    if photos_per_move is not None and photos_per_move == p_count:
-                        return images_array
-                    else:
-                        # Save actual file (image) info.
-                        photo = Photo()
-                        photo.directory = root
-                        photo.name = file
-                        d_numbers = os.path.getctime(os.path.join(root, file))
-                        photo.size = os.path.getsize(os.path.join(root, file))
-                        d_numbers = datetime.fromtimestamp(d_numbers).strftime(
-                            '%Y%m%d%H%M%S')  # directory date, in Win the creation.
-                        photo.ddate.covert_continue(d_numbers)
-                        # Get Exif timestamp
-                        actual_image = Image(open(os.path.join(root, file), 'rb'))
-                        if actual_image.has_exif:
-                            for exif_tag in dir(actual_image):
-                                if exif_tag == 'datetime_original':
-                                    # print("this works, you're amazing!")
-                                    to_format = actual_image.datetime_original
-                                    if isinstance(to_format, str):
-                                        c_numbers = "".join(str(elem) for elem in list(filter(str.isdigit, to_format)))
-                                        photo.cdate.covert_continue(str(c_numbers))
-                        # Title timestamp
-                        t_numbers = list(filter(str.isdigit, file))
-                        if len(t_numbers) == 14:
-                            t_numbers = "".join(str(elem) for elem in t_numbers)
-                            photo.tdate.covert_continue(t_numbers)
-                        # Add object to array.
-                        images_array.append(photo)
-                        p_count += 1
-    return images_array
+            if photos_per_move is not None and photos_per_move == len(to_index):
+                break
+            if file.lower().endswith(tuple(suffixes)):
+                to_index.append([root, file])
+    paths = [os.path.join(root, file) for root, file in to_index]
+    if processes is not None and len(paths) >= min_parallel_index:
+        files_info = read_files_info(paths, processes)
+    else:
+        files_info = [read_file_info(path) for path in paths]
+    # Add objects to array.
+    photos = []
+    for [root, file], info in zip(to_index, files_info):
+        try:
+            photos.append(photo_from_info(root, file, info))
+        except Exception as e:
+            if on_error is None:
+                raise
+            photo = Photo()
+            photo.directory = root
+            photo.name = file
+            photo.size = info[0]
+            on_error(photo, e)
+    return photos
+
+
+def get_photo(root, file):
+    """
+    Gets the info (size and directory, EXIF and title dates) of a single file.
+    :param root: The directory where the file is located.
+    :param file: The name of the file.
+    :return: Photo-type object.
+    """
+    return photo_from_info(root, file, read_file_info(os.path.join(root, file)))
+
+
+def photo_from_info(root, file, info):
+    """
+    Builds the Photo of a file from its metadata.
+    :param root: The directory where the file is located.
+    :param file: The name of the file.
+    :param info: Tuple (size, creation time, EXIF date) as returned by read_file_info.
+    :return: Photo-type object.
+    """
+    size, ctime, to_format = info
+    # Save actual file (image) info.
+    photo = Photo()
+    photo.directory = root
+    photo.name = file
+    photo.size = size
+    d_numbers = datetime.fromtimestamp(ctime).strftime('%Y%m%d%H%M%S')  # directory date, in Win the creation.
+    photo.dstamp = Date.pack(d_numbers)
+    # Get Exif timestamp
+    if to_format is not None:
+        c_numbers = "".join(str(elem) for elem in list(filter(str.isdigit, to_format)))
+        photo.cstamp = Date.pack(str(c_numbers))
+    # Title timestamp
+    t_numbers = list(filter(str.isdigit, file))
+    if len(t_numbers) == 14:
+        t_numbers = "".join(str(elem) for elem in t_numbers)
+        photo.tstamp = Date.pack(t_numbers)
+    return photo
 
 
 def log_pull_status(a, bytes_written=0, total_bytes=0):
-    print(f"\rMoving {os.path.basename(a)} - {round(bytes_written / total_bytes * 100, 1)}%", end="")
+    run_progress.transfer(a, bytes_written, total_bytes)
+    pull_progress.update(f"Moving {os.path.basename(a)} - {round(bytes_written / total_bytes * 100, 1)}%")
 
 
-def scan_phone_tcp(to_search_path, remote_ip, adb_key_file, max_files=None):
+def scan_phone_tcp(to_search_paths, remote_ip, adb_key_file, temp_path, max_files=None, workers=1, keep_files=False,
+                   on_pulled=None, budget=None, device_hash=False, recursive=False, tar=False, resume=False,
+                   limiter=None, sessions=None):
     """
-    Search in the given directory for .jpg files and copy them to a temporarily folder.
+    Search in the given directories for photos and videos (see media_suffixes) and copy them to a temporarily folder.
     By default the 5555 port is used.
-    After comparison, they're deleted from the original path.
-    :param to_search_path: The path where the files are located.
+    The files are pulled while the directory is still being listed. Every file queued and pulled is written to a
+    journal, so that a killed run can be resumed.
+    Files already pulled in a previous run (same path, size and modification time) are skipped.
+    Once they're verified in the backup folder, they're deleted from the original path (see remove_backed_up).
+    :param to_search_paths: Array of paths where the files are located.
     :param remote_ip: The IP of the device where the files are located.
     :param adb_key_file: The ADB key of the device to be connected.
+    :param temp_path: The temp folder where the files are pulled.
     :param max_files: The number of files to be moved.
-    :return: True
+    :param workers: The number of simultaneous ADB connections used to pull the files.
+    :param keep_files: Don't delete the files from the device.
+    :param on_pulled: Called with each AndroidPhoto-type object as soon as it's in the temp folder.
+    :param budget: ByteBudget limiting the bytes waiting in the temp folder.
+    :param device_hash: Hash the files on the device, so those already in the backup aren't pulled and the pulled ones
+    are checked against the hash.
+    :param recursive: Search also in the subfolders of the directory.
+    :param tar: Pull the small files of each folder in batches, as a single tar stream.
+    :param resume: Pull the files left by a killed run (from its journal) instead of listing the directory.
+    :param limiter: RateLimiter of the pulls, maybe shared with other devices.
+    :param sessions: SessionPool where the ADB connections are taken from and given back, so they're kept open.
+    :return: Array [number of files pulled, number of files that couldn't be pulled]
     """
-    android_images = []
+    # The ADB library is only imported once a device is backed up.
+    from transfer import PullJournal, PullPool, connect_device, device_hashes, device_serial
+
+    stored = 0
+    # Small files waiting to be pulled together, by folder.
+    small_files = {}
+    # {local route: remote route} of the files queued, two files can't be pulled to the same local route.
+    queued_routes = {}
+    device_id = remote_ip
+    journal = PullJournal(temp_path, resume=resume)
+    pool = None
+    device = None
+    try:
+        run_progress.stage(remote_ip, 'connecting')
+        signer = load_signer(adb_key_file)
+        device = sessions.acquire(remote_ip, signer) if sessions is not None else connect_device(remote_ip, signer)
+        if device is not None:
+            if device.available:
+                print("Connected to selected device.\n---")
+            run_progress.stage(remote_ip, 'listing')
+            device_id = device_serial(device, remote_ip)
+
+        def pulled_file(image):
+            image.device = device_id
+            journal.pulled(image)
+            syncManifest.add(device_id, image)
+            run_progress.transfer(image.path + image.name, image.size, image.size)
+            run_progress.add('pulled')
+            run_progress.add('pulled_bytes', image.size)
+            if on_pulled is not None:
+                on_pulled(image)
+
+        # The listing keeps its own connection, so the pulls need their own ones.
+        pool = PullPool(remote_ip, signer, temp_path, workers=workers, progress_callback=log_pull_status,
+                        on_pulled=pulled_file, budget=budget, limiter=limiter, sessions=sessions)
+
+        # Returns the number of files already in the backup, the others are queued.
+        def queue_files(android_images):
+            in_backup = 0
+            # Through the listing connection, while its find stream is still open (see adb-shell in requirements.txt).
+            hashes = device_hashes(device, android_images) if device_hash and android_images else {}
+            for image in android_images:
+                if device_hash:
+                    image.hash = hashes.get(image.path + image.name)
+                    if image.hash is not None and hashIndex.get(image.hash):
+                        syncManifest.add(device_id, image)
+                        if not keep_files:
+                            deletions.add(device_id, image.path + image.name)
+                        in_backup += 1
+                        continue
+                queue_image(image)
+            return in_backup
+
+        def queue_image(image, journaled=False):
+            local_route = os.path.normcase(os.path.join(image.subfolder, image.name))
+            if local_route in queued_routes:
+                # Unless it's the same file listed twice (e.g. in a folder and in its parent, with --recursive), the
+                # names only differ in case and the temp folder is case-insensitive.
+                if queued_routes[local_route] != image.path + image.name:
+                    print(f"\r\r{image.path + image.name} goes to the same temp file as "
+                          f"{queued_routes[local_route]}, it's left on the device.")
+                return
+            queued_routes[local_route] = image.path + image.name
+            if not journaled:
+                journal.queued(image)
+            run_progress.add('listed')
+            if tar and image.size <= tar_max_size:
+                small_files.setdefault(image.path, []).append(image)
+                if len(small_files[image.path]) >= tar_batch:
+                    pool.put_tar(small_files.pop(image.path))
+            else:
+                pool.put(image)
+
+        if device is not None and resume:
+            # The files queued by the killed run, there's no need to list the device.
+            for image in journal.pending():
+                queue_image(image, journaled=True)
+        elif device is not None:
+            known = syncManifest.pulled(device_id)
+            # Files are hashed on the device in batches, otherwise they're queued as soon as they're listed.
+            batch = []
+            for save in new_files(device, to_search_paths, known, recursive, max_files):
+                batch.append(save)
+                if not device_hash or len(batch) >= hash_batch:
+                    stored += queue_files(batch)
+                    batch = []
+            stored += queue_files(batch)
+        if device is not None:
+            for images in small_files.values():
+                pool.put_tar(images)
+        if device_hash:
+            print(f"There're {stored} files already in the backup, they won't be pulled.")
+        print(f"There're listed {len(queued_routes)} new files in {remote_ip}.\n---")
+        run_progress.stage(remote_ip, 'pulling')
+    finally:
+        if device is not None:
+            if sessions is not None:
+                sessions.release(remote_ip, device)
+            else:
+                device.close()
+        # After an error, the files already queued are still pulled (or reported as failed).
+        pulled, failed = pool.finish() if pool is not None else [[], []]
+        journal.close()
+    for image in failed:
+        runManifest.record('failed', error="Couldn't be pulled.", name=image.name, size=image.size, hash=image.hash,
+                           device=device_id, remote=image.path + image.name)
+        run_progress.add('failed')
+    if failed:
+        print(f"---\n{len(failed)} files couldn't be pulled, they're still on the device.")
+    print(f"---\nAll files of {remote_ip} are now in the temp folder.\n---")
+    run_progress.stage(remote_ip, 'pulled')
+    return [len(pulled), len(failed)]
+
+
+def new_files(device, folders, known, recursive=False, max_files=None):
+    """
+    Lists the media files (see media_suffixes) of the device folders that haven't been pulled yet.
+    :param device: The connected AdbDeviceTcp.
+    :param folders: Array of the device folders.
+    :param known: Dictionary {remote route: (size, modification time)} of the files already pulled (see
+    SyncManifest.pulled).
+    :param recursive: Search also in the subfolders.
+    :param max_files: The maximum number of files listed.
+    :return: Generator of AndroidPhoto-type objects.
+    """
+    from transfer import list_files
+
+    listed = 0
+    for folder in folders:
+        for save in list_files(device, folder, recursive=recursive):
+            if (os.path.splitext(save.name)[1].lower() not in media_suffixes()
+                    or known.get(save.path + save.name) == (save.size, save.mtime)):
+                continue
+            yield save
+            listed += 1
+            if max_files is not None and listed >= max_files:
+                return
+
+
+def load_signer(adb_key_file):
+    from adb_shell.auth.sign_pythonrsa import PythonRSASigner
+
     with open(adb_key_file) as f:
         priv = f.read()
-    signer = PythonRSASigner('', priv)
-    device = AdbDeviceTcp(remote_ip, 5555, default_transport_timeout_s=100.)
-    if device.connect(rsa_keys=[signer], auth_timeout_s=100.):
-        if device.available:
-            print("Connected to selected device.\n---")
-        directory_scan = device.list(to_search_path, None, 9000)
-        if max_files is None:
-            max_files = len(directory_scan)
-        for file in directory_scan:
-            if os.path.splitext(file.filename.decode('utf-8'))[1] == ".jpg":
-                save = AndroidPhoto()
-                save.name = file.filename.decode("utf-8")
-                save.size = file.size
-                save.path = to_search_path
-                android_images.append(save)
-                if len(android_images) >= max_files:
-                    break
-    print(f"There're listed {len(android_images)} files.\n---")
-    for image in android_images:
-        device.pull(image.path + image.name, os.path.join(temp_directory, image.name),
-                    progress_callback=log_pull_status,
-                    transport_timeout_s=100, read_timeout_s=100)
-        if image.size == os.path.getsize(os.path.join(temp_directory, image.name)):
-            device.shell('rm -f ' + to_search_path + image.name)
-            print("\r\r" + image.name + " is now in the temp folder.")
-    print("---\nAll files are now in the temp folder.\n---")
-    return True
-
-
-def map_directory(home_path):
-    """
-    Map the backup directory.
-    Scan a given directory for subfolders in the defined backup structure.
-    :param home_path: the path to map.
-    :return: (complex) Array
-    """
-    to_index = None
-    for dirpath, dirnames, filenames in os.walk(home_path):
-        if dirnames != []:
-            if os.path.split(os.path.relpath(dirpath, home_path))[1] == os.path.relpath(home_path, home_path):
-                to_index = dirnames
-            else:
-                for i, item in enumerate(to_index):
-                    if os.path.relpath(os.path.split(dirpath)[0], home_path) == os.path.relpath(home_path, home_path):
-                        if os.path.split(dirpath)[1] == item:
-                            to_index[i] = [item, dirnames]
-                    else:
-                        if os.path.relpath(os.path.split(os.path.split(dirpath)[0])[0], home_path) == os.path.relpath(
-                                home_path, home_path):
-                            if type(item) == list:
-                                if item[0] == os.path.split(os.path.relpath(dirpath, home_path))[0]:
-                                    for x, month in enumerate(item[1]):
-                                        if os.path.split(os.path.relpath(dirpath, home_path))[1] == month:
-                                            to_index[i][1][x] = [month, dirnames]
-    if type(to_index) == list:
-        for z, eachYear in enumerate(to_index):
-            if type(eachYear) == str:
-                to_index[z] = [to_index[z], []]
-            elif type(eachYear) == list:
-                for d, eachMonth in enumerate(eachYear[1]):
-                    if type(eachMonth) == str:
-                        to_index[z][1][d] = [to_index[z][1][d], []]
+    return PythonRSASigner('', priv)
+
+
+def remove_backed_up(remote_ip, adb_key_file, sessions=None):
+    """
+    Removes from the device the files already verified in the backup folder (including those left by previous runs),
+    in batches of rm commands.
+    :param remote_ip: The IP of the device where the files are located.
+    :param adb_key_file: The ADB key of the device to be connected.
+    :param sessions: SessionPool where the ADB connection is taken from and given back.
+    :return: The number of files removed.
+    """
+    from transfer import connect_device, delete_files, device_serial
+
+    signer = load_signer(adb_key_file)
+    device = sessions.acquire(remote_ip, signer) if sessions is not None else connect_device(remote_ip, signer)
+    if device is None:
+        return 0
+    device_id = device_serial(device, remote_ip)
+    to_delete = deletions.pending(device_id)
+    delete_files(device, to_delete)
+    deletions.remove(device_id, to_delete)
+    if sessions is not None:
+        sessions.release(remote_ip, device)
     else:
-        to_index = []
-    return to_index
-
-
-def search_directory(indexed_path, find_y, find_m, find_d):
-    """
-    Search for the existing Y, M and D folders.
-    :param indexed_path: (complex) Array
-    :param find_y: The year to find
-    :param find_m: The month to find
-    :param find_d: The day to find
-    :return: Array [year, month, day, index, index, index]
-    """
-    is_year = False
-    is_month = False
-    is_day = False
-    index_y = None
-    index_m = None
-    index_d = None
-    for i, exst_y in enumerate(indexed_path):
-        if type(exst_y) == str:
-            if find_y == exst_y:
-                is_year = True
-                index_y = i
-                break
-        elif type(exst_y) == list:
-            if exst_y[0] == find_y:
-                is_year = True
-                index_y = i
-                for x, exst_m in enumerate(exst_y[1]):
-                    if type(exst_m) == str:
-                        if find_m == exst_m:
-                            is_month = True
-                            index_m = x
-                            break
-                    elif type(exst_m) == list:
-                        if exst_m[0] == find_m:
-                            is_month = True
-                            index_m = x
-                            for d, exst_d in enumerate(exst_m[1]):
-                                if exst_d == find_d:
-                                    is_day = True
-                                    index_d = d
-                                    break
-    return [is_year, is_month, is_day, index_y, index_m, index_d]
-
-
-def are_equal(original_f, copy_f):
-    """
-     Checks for differences in two files.
-    :param original_f: should be a Photo type object.
-    :param copy_f: is the final route of the file
-    :return: Array of Booleans
-    """
-    equal_size = False
-    if original_f.size == os.path.getsize(copy_f):
-        equal_size = True
-    py_compares = filecmp.cmp(os.path.join(original_f.directory, original_f.name), copy_f)
-    equal_exif = None
-    image_original_f = Image(open(os.path.join(original_f.directory, original_f.name), 'rb'))
-    image_copy_f = Image(open(copy_f, 'rb'))
-    if image_original_f.has_exif and image_copy_f.has_exif:
-        if dir(image_original_f) == dir(image_copy_f):
-            equal_exif = True
+        device.close()
+    return len(to_delete)
+
+
+def backup_device(remote_ip, adb_key_file, folders, temp_path, limiter=None, sessions=None, resume=False,
+                  on_pulled=None):
+    """
+    Backs up the given folders of a device (several devices can be backed up at the same time, each one in its own
+    thread). The files pulled go to the pipeline shared by every device.
+    :param remote_ip: The IP of the device.
+    :param adb_key_file: The ADB key of the device.
+    :param folders: Array of the device folders to backup.
+    :param temp_path: The temp folder of the device.
+    :param limiter: RateLimiter shared by every device.
+    :param sessions: SessionPool of the ADB connections, kept open between backups.
+    :param resume: Pull the files left by a killed run instead of listing the folders.
+    :param on_pulled: Called with each file pulled, by default it goes to the pipeline.
+    :return: Array [number of files pulled, number of files that couldn't be pulled]
+    """
+    os.makedirs(temp_path, exist_ok=True)
+    return scan_phone_tcp(folders, remote_ip, adb_key_file, temp_path, max_files=max_android_files,
+                          workers=args.workers, keep_files=args.keep_files, on_pulled=on_pulled or pulledQueue.put,
+                          budget=budget, device_hash=args.device_hash, recursive=args.recursive, tar=args.tar,
+                          resume=resume, limiter=limiter, sessions=sessions)
+
+
+def watch_devices(devices, interval, limiter=None):
+    """
+    Runs until it's interrupted (Ctrl+C), checking every interval seconds which devices are on the network. Each
+    device is backed up as soon as it appears, and the files verified since are removed from it while it's still
+    there. The ADB connections are kept open until the device leaves, so they're authenticated once per visit.
+    :param devices: Array of [IP, ADB key, array of folders].
+    :param interval: The seconds between two checks.
+    :param limiter: RateLimiter shared by every device.
+    :return: None
+    """
+    from transfer import SessionPool, probe_device, transport_errors
+
+    sessions = SessionPool()
+    present = set()
+    backups = {}
+
+    def backup_finished(remote_ip, backup):
+        if backup.exception() is not None:
+            print(f"{remote_ip} couldn't be backed up: {backup.exception()}")
+            openLog.write(f"{remote_ip} couldn't be backed up: {backup.exception()}\n")
+            # Maybe the connections were broken, the next check starts again.
+            sessions.discard(remote_ip)
+            present.discard(remote_ip)
+
+    print(f"---\nWatching {len(devices)} devices, press Ctrl+C to stop.\n---")
+    with ThreadPoolExecutor(max_workers=len(devices)) as executor:
+        try:
+            while True:
+                for remote_ip, adb_key, folders in devices:
+                    running = remote_ip in backups and not backups[remote_ip].done()
+                    if running:
+                        continue
+                    if not probe_device(remote_ip):
+                        if remote_ip in present:
+                            print(f"---\n{remote_ip} has left the network.\n---")
+                            present.discard(remote_ip)
+                            sessions.discard(remote_ip)
+                        continue
+                    if remote_ip not in present:
+                        print(f"---\n{remote_ip} is on the network, starting its backup.\n---")
+                        present.add(remote_ip)
+                        temp_path = temp_directory if len(devices) == 1 else os.path.join(temp_directory, remote_ip)
+                        # Only the first backup of each device can resume the killed run.
+                        resume = args.resume and remote_ip not in backups
+                        backups[remote_ip] = executor.submit(backup_device, remote_ip, adb_key, folders, temp_path,
+                                                             limiter, sessions, resume)
+                        backups[remote_ip].add_done_callback(lambda b, ip=remote_ip: backup_finished(ip, b))
+                    elif not args.keep_files:
+                        try:
+                            removed = remove_backed_up(remote_ip, adb_key, sessions)
+                        except transport_errors:
+                            # Tried again in the next check.
+                            removed = 0
+                            sessions.discard(remote_ip)
+                        if removed:
+                            print(f"---\n{removed} files removed from {remote_ip}.")
+                hashIndex.commit()
+                syncManifest.commit()
+                if args.metrics_prom:
+                    run_metrics.write_prometheus(args.metrics_prom)
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            print("---\nStopping, waiting for the running backups.\n---")
+    sessions.close()
+
+
+def pulled_photo(image):
+    photo = get_photo(os.path.dirname(image.local_path), image.name)
+    # Already checked against the file pulled.
+    photo.hash = image.hash
+    photo.device = image.device
+    photo.remote = image.path + image.name
+    return photo
+
+
+def place_photo(element):
+    """
+    Copies a file of the temp folder to its year/month/day folder.
+    If both folders are in the same filesystem, the file is just renamed and there's nothing else to check.
+    Files already in the backup (same hash) aren't copied again, they're just removed from the temp folder (or linked
+    in the day folder).
+    :param element: Photo-type object.
+    :return: Array [Photo-type object, final route of the file], or None if there's nothing else to do.
+    """
+    originalFile = os.path.join(element.directory, element.name)
+    if element.hash is None:
+        element.hash = hash_file(originalFile)
+    if dailyPacks is not None:
+        return pack_photo(element, originalFile)
+    backupDirectory = dateIndex.ensure(element.get_year(), element.get_month(), element.get_day())
+    # With several disk writers, the names are taken (and the duplicates looked for) one at a time.
+    with placementLock:
+        storedFile, backupName = backup_name(element, backupDirectory)
+        if storedFile is not None:
+            # Files stored in a pack (by a run with --packs) can't be linked.
+            if (args.duplicates == 'link' and not os.path.exists(os.path.join(backupDirectory, backupName))
+                    and os.path.isfile(storedFile)):
+                os.link(storedFile, os.path.join(backupDirectory, backupName))
+            os.remove(originalFile)
+        elif sameDevice:
+            movedFile = move_atomic(originalFile, backupDirectory, backupName)
         else:
-            equal_exif = False
-    elif image_original_f.has_exif:
-        equal_exif = False
-    if equal_size and py_compares and ((equal_exif is None) or equal_exif):
-        return [True, equal_size, py_compares, equal_exif]
+            # The name is kept until the copy is written.
+            open(os.path.join(backupDirectory, backupName), 'xb').close()
+    if storedFile is not None:
+        photo_done([element, storedFile], duplicate=True)
+        return None
+    # Move archive
+    if sameDevice:
+        photo_done([element, movedFile])
+        return None
+    try:
+        movedFile, copyHash = copy_hashed(originalFile, backupDirectory, backupName)
+        if copyHash != element.hash:
+            raise Error(element.name + " changed while it was copied.")
+    except Exception:
+        discard_copy(os.path.join(backupDirectory, backupName))
+        raise
+    return [element, movedFile]
+
+
+def discard_copy(backupFile):
+    # Removes a wrong or partial copy (or the empty file keeping its name), so a retry can take the same name.
+    try:
+        os.remove(backupFile)
+    except FileNotFoundError:
+        pass
+
+
+def pack_photo(element, originalFile):
+    """
+    Appends a file of the temp folder to the pack of its day (with --packs). Files already in the backup aren't
+    appended again, they're just removed from the temp folder.
+    :param element: Photo-type object, with its hash.
+    :param originalFile: The route of the file in the temp folder.
+    :return: Array [Photo-type object, stored route of the file], or None if there's nothing else to do.
+    """
+    with placementLock:
+        storedFile = hashIndex.get(element.hash)
+    if storedFile is not None:
+        os.remove(originalFile)
+        photo_done([element, storedFile], duplicate=True)
+        return None
+    packedFile, copyHash = dailyPacks.append(originalFile, element.get_year(), element.get_month(), element.get_day(),
+                                             element.name, element.hash)
+    if copyHash != element.hash:
+        raise Error(element.name + " changed while it was copied.")
+    return [element, packedFile]
+
+
+def backup_name(element, backupDirectory):
+    """
+    Looks for the file in the backup and, if it isn't, for a free name in its day folder.
+    :param element: Photo-type object, with its hash.
+    :param backupDirectory: The day folder of the file.
+    :return: Array [route of the file already in the backup or None, name of the file in the day folder]
+    """
+    storedFile = hashIndex.get(element.hash)
+    backupName = element.name
+    # Check for same name
+    if os.path.exists(os.path.join(backupDirectory, backupName)):
+        if storedFile is None:
+            # The file was backed up before there was a hash index.
+            existingHash = hash_file(os.path.join(backupDirectory, backupName))
+            hashIndex.add(existingHash, os.path.join(backupDirectory, backupName))
+            if existingHash == element.hash:
+                storedFile = os.path.join(backupDirectory, backupName)
+        if storedFile != os.path.join(backupDirectory, backupName):
+            backupName = unique_name(backupName, element.hash)
+    return [storedFile, backupName]
+
+
+def verify_photo(moved):
+    """
+    Checks the copy of a file (size and, unless the fsync'd write is trusted, hash) and, if it's right, removes it
+    from the temp folder.
+    :param moved: Array [Photo-type object, final route of the file]
+    :return: None
+    """
+    element, movedFile = moved
+    if dailyPacks is not None:
+        right = dailyPacks.verify(movedFile, element.size, None if args.trust_fsync else element.hash)
     else:
-        return [False, equal_size, py_compares, equal_exif]
-
-
-print("---\nJABS, an open source backup system developed by Juan Cerdeño. Learn more at "
-      "https://www.github.com/ajuancer/jabs.\n---")
-# Start of program
-scan_phone_tcp(android_path, phone_ip, adbkey_route, max_files=max_android_files)
-
-# Prepare files.
-initImages = get_images(temp_directory, ['.jpg'], photos_per_move=100)
-
-openData = open(os.path.join(bckpPath, ("data_" + datetime.today().strftime("%M-%d-%m-%Y") + ".json")), "w+",
-                encoding='utf-8')
-openLog = open(os.path.join(bckpPath, ("log_" + datetime.today().strftime("%M-%d-%m-%Y") + ".txt")), "w+",
-               encoding='utf-8')
-
-# Copy photos to backup folder.
-errorImages = []
-movedImages = []
-print("Organizing files (moving imgs to final location).\n---")
-while len(initImages) != 0:
-    for i, element in enumerate(initImages):
-        directoryStatus = search_directory(map_directory(bckpPath), str(element.get_year()), str(element.get_month()),
-                                           str(element.get_day()))
-        if directoryStatus[0]:
-            if directoryStatus[1]:
-                if directoryStatus[2]:
-                    # Check for same name
-                    backupDirectory = os.path.join(bckpPath,
-                                                   os.path.join(str(map_directory(bckpPath)[directoryStatus[3]][0]),
-                                                                os.path.join(str(
-                                                                    map_directory(bckpPath)[directoryStatus[3]][1][
-                                                                        directoryStatus[4]][0]), str(
-                                                                    map_directory(bckpPath)[directoryStatus[3]][1][
-                                                                        directoryStatus[4]][1][
-                                                                        directoryStatus[5]]))))
-                    if os.path.exists(os.path.join(backupDirectory, element.name)):
-                        os.rename(os.path.join(backupDirectory, element.name), os.path.join(backupDirectory,
-                                                                                            os.path.splitext(
-                                                                                                element.name)[
-                                                                                                0] + "_" + str(
-                                                                                                random.randint(0,
-                                                                                                               40)) + "_" + str(
-                                                                                                datetime.now().minute) + "_" + str(
-                                                                                                datetime.now().second) +
-                                                                                            os.path.splitext(
-                                                                                                element.name)[1]))
-                else:
-                    # We don't have day folder.
-                    try:
-                        os.mkdir(
-                            os.path.join(bckpPath, os.path.join(str(map_directory(bckpPath)[directoryStatus[3]][0]),
-                                                                os.path.join(str(
-                                                                    map_directory(bckpPath)[directoryStatus[3]][1][
-                                                                        directoryStatus[4]][0]),
-                                                                    str(element.get_day())))))
-                    except FileExistsError:
-                        print("We should review mapDirectory() #1")
-                        openLog.write("We should review mapDirectory() #1\n")
-                        sys.exit()
-            else:
-                # We don't have month folder.
-                try:
-                    os.makedirs(os.path.join(bckpPath, os.path.join(str(element.get_year()),
-                                                                    os.path.join(str(element.get_month()),
-                                                                                 str(element.get_day())))))
-                except FileExistsError:
-                    print("We should review mapDirectory() #2")
-                    openLog.write("We should review mapDirectory() #2\n")
-                    sys.exit()
-        else:
-            # We don't have even a year folder.
-            try:
-                os.makedirs(os.path.join(bckpPath, os.path.join(str(element.get_year()),
-                                                                os.path.join(str(element.get_month()),
-                                                                             str(element.get_day())))))
-            except FileExistsError:
-                print("We should review mapDirectory() #3")
-                openLog.write("We should review mapDirectory() #3\n")
-                sys.exit()
-        # Move archive
-        directoryStatus = search_directory(map_directory(bckpPath), str(element.get_year()), str(element.get_month()),
-                                           str(element.get_day()))
-        backupDirectory = os.path.join(bckpPath, os.path.join(str(element.get_year()),
-                                                              os.path.join(str(element.get_month()),
-                                                                           str(element.get_day()))))
-        movedFile = None
-        if directoryStatus[0] and directoryStatus[1] and directoryStatus[2] and not (
-                os.path.exists(os.path.join(backupDirectory, element.name))):
-            movedFile = shutil.copy2(os.path.join(element.directory, element.name), backupDirectory)
-            if are_equal(element, movedFile)[0]:
-                print(element.name + " has been moved successfully.")
+        right = (element.size == os.path.getsize(movedFile)
+                 and (args.trust_fsync or hash_file(movedFile) == element.hash))
+    if not right:
+        # A file in a pack stays there, its index entry isn't used by the retry if the hash differs.
+        if dailyPacks is None:
+            discard_copy(movedFile)
+        raise Error("Something went wrong with the internal management #6")
+    try:
+        os.remove(os.path.join(element.directory, element.name))
+    except IsADirectoryError:
+        raise Error("Couldn't remove original file. #4")
+    photo_done(moved)
+
+
+def photo_done(moved, duplicate=False):
+    budget.release(moved[0].size)
+    # The file is verified in the backup, so it can be removed from the device.
+    if moved[0].remote is not None and not args.keep_files:
+        deletions.add(moved[0].device, moved[0].remote)
+    if duplicate:
+        runManifest.record('duplicate', destination=moved[1], **moved[0].to_record())
+        run_progress.add('duplicates')
+        print(moved[0].name + " is already in the backup (" + moved[1] + ").")
+        return
+    if perceptualIndex is not None:
+        moved[1] = check_near_duplicate(moved[0], moved[1])
+    hashIndex.add(moved[0].hash, moved[1])
+    copied = runManifest.record('copied', destination=moved[1], **moved[0].to_record())
+    run_progress.add('copied')
+    print(moved[0].name + " has been moved successfully. There're copied " + str(copied) + ".")
+
+
+def check_near_duplicate(element, storedFile):
+    """
+    Looks for photos of the backup that look the same as a new one (burst shots, re-shared copies...), which the
+    content hash doesn't catch. They're written in the run manifest and, with --near_duplicates quarantine, the new
+    photo is moved to the quarantine folder of the backup.
+    :param element: Photo-type object.
+    :param storedFile: The route of the photo in the backup.
+    :return: The final route of the photo.
+    """
+    if not storedFile.lower().endswith(perceptual_suffixes):
+        return storedFile
+    with run_metrics.timed('perceptual', element.size):
+        # A packed photo is read straight from its pack.
+        phash = dhash(dailyPacks.open_member(storedFile) if dailyPacks is not None else storedFile)
+        # Not decodable, or plain (no edges at all), it would look like every other plain image.
+        if not phash:
+            return storedFile
+        similar = perceptualIndex.near(phash, args.near_distance)
+    # Packed photos stay in their pack, they're only reported.
+    if similar and args.near_duplicates == 'quarantine' and dailyPacks is None:
+        quarantineDirectory = os.path.join(bckpPath, quarantine_name)
+        os.makedirs(quarantineDirectory, exist_ok=True)
+        with placementLock:
+            quarantineName = element.name
+            if os.path.exists(os.path.join(quarantineDirectory, quarantineName)):
+                quarantineName = unique_name(quarantineName, element.hash)
+            storedFile = move_atomic(storedFile, quarantineDirectory, quarantineName)
+    perceptualIndex.add(storedFile, phash)
+    if similar:
+        runManifest.record('near_duplicate', destination=storedFile, similar=[path for path, distance in similar],
+                           **element.to_record())
+        print(f"{element.name} looks like {similar[0][0]}.")
+    return storedFile
+
+
+def stage_failed(item, error):
+    element = item[0] if isinstance(item, list) else item
+    budget.release(element.size)
+    record_failed(element, error)
+
+
+# Writes a file that couldn't be backed up to the manifest, the progress and the log.
+def record_failed(element, error):
+    message = error.message if isinstance(error, Error) else f"{type(error).__name__}: {error}"
+    if isinstance(element, Photo):
+        record = element.to_record()
+    else:
+        # Not even its metadata was read.
+        record = {'name': element.name, 'size': element.size, 'hash': element.hash, 'device': element.device,
+                  'remote': element.path + element.name}
+    runManifest.record('failed', error=message, **record)
+    run_progress.add('failed')
+    run_progress.message(f"{element.name} couldn't be backed up. {message}")
+    print(f"{element.name} couldn't be backed up. {message}")
+    openLog.write(f"{element.name} couldn't be backed up. {message}\n")
+
+
+class RunResult(object):
+    """
+    What a run of backup, pull or organize did.
+    """
+
+    def __init__(self, counts=None, removed=0, failed_devices=None, manifest_file=None, metrics=None):
+        super(RunResult, self).__init__()
+        # Number of files of each status of the run manifest (copied, duplicate, near_duplicate, failed).
+        self.counts = counts or {}
+        self.removed = removed
+        # {IP: error} of the devices that couldn't be backed up.
+        self.failed_devices = failed_devices or {}
+        self.manifest_file = manifest_file
+        # Time and throughput of each stage, see Metrics.summary.
+        self.metrics = metrics or {}
+
+    @property
+    def copied(self):
+        return self.counts.get('copied', 0)
+
+    @property
+    def duplicates(self):
+        return self.counts.get('duplicate', 0)
+
+    @property
+    def failed(self):
+        return self.counts.get('failed', 0)
+
+    @property
+    def ok(self):
+        return not self.failed and not self.failed_devices
+
+
+# There's a single run at a time in each process, its state is kept in the globals set by start_run.
+run_lock = threading.Lock()
+
+
+def backup_config(phone_ip, adb_key, backup_dir, phone_dir, **options):
+    """
+    Builds the configuration of a run, the same the command line gives.
+    :param phone_ip: The IP of the device, or a JSON file listing several devices (see load_devices).
+    :param adb_key: The ADB key of the device.
+    :param backup_dir: The backup folder.
+    :param phone_dir: The device folder to backup.
+    :param options: Any option of the command line (e.g. workers=4, keep_files=True), the rest get their default.
+    :return: argparse.Namespace
+    """
+    try:
+        validate_device_form(phone_ip)
+    except argparse.ArgumentTypeError:
+        raise Error(f"{phone_ip} is neither an IP nor a devices file.")
+    config = backup_parser.parse_args([phone_ip, adb_key, backup_dir, phone_dir])
+    for option, value in options.items():
+        if not hasattr(config, option):
+            raise Error(f"Unknown option: {option}.")
+        setattr(config, option, value)
+    return config
+
+
+def config_paths(config):
+    """
+    :param config: The configuration of the run (see backup_config).
+    :return: Array [backup folder, temp folder, ADB key]
+    """
+    # The separators of the host (either / or \ on Windows), so absolute paths work on every system.
+    backup_path = os.path.normpath(config.backup_dir)
+    if config.temp_dir:
+        temp_path = os.path.normpath(config.temp_dir)
+    else:
+        temp_path = os.path.join(os.path.split(backup_path)[0], 'jabs_tmp')
+    return [backup_path, temp_path, os.path.normpath(config.adb_key)]
+
+
+def config_devices(config):
+    """
+    :param config: The configuration of the run (see backup_config).
+    :return: Array of [IP, ADB key, array of folders]
+    """
+    adbkey_route = config_paths(config)[2]
+    # Last bar is important. Bar position is important.
+    android_path = config.phone_dir.replace("\\", "/")
+    if not os.path.exists(adbkey_route):
+        raise Error("The specified ADB key was not found.")
+    if os.path.isfile(config.phone_ip):
+        return load_devices(config.phone_ip, adbkey_route, android_path)
+    return [[config.phone_ip, adbkey_route, [android_path]]]
+
+
+def start_run(config, temp_budget=None):
+    """
+    Prepares the folders, indexes and manifests of a run. They're kept in the globals used by the stages.
+    :param config: The configuration of the run (see backup_config).
+    :param temp_budget: The maximum bytes waiting in the temp folder, by default the ones of the configuration.
+    :return: Array of devices [IP, ADB key, array of folders].
+    """
+    global args, max_android_files, bckpPath, temp_directory, runManifest, openLog, hashIndex, deletions, syncManifest, \
+        perceptualIndex
+    args = config
+    max_android_files = args.max_android_files or None
+    bckpPath, temp_directory, adbkey_route = config_paths(args)
+    devices = config_devices(args)
+    for path in [bckpPath, temp_directory]:
+        if not os.path.exists(path):
+            os.makedirs(path)
+    run_metrics.reset()
+    run_progress.reset()
+    # Whatever is opened is closed again if the run can't be started (see abort_run).
+    runManifest = openLog = hashIndex = deletions = syncManifest = perceptualIndex = None
+    try:
+        open_run(temp_budget)
+    except BaseException:
+        abort_run([])
+        raise
+    return devices
+
+
+def open_run(temp_budget=None):
+    """
+    Opens the manifests, indexes and log of the run (see start_run), kept in the globals used by the stages.
+    :param temp_budget: The maximum bytes waiting in the temp folder, by default the ones of the configuration.
+    :return: None
+    """
+    global runManifest, openLog, dateIndex, hashIndex, deletions, syncManifest, budget, placementLock, dailyPacks, \
+        perceptualIndex, dhash, perceptual_suffixes, sameDevice
+    # What's done with each file is written as soon as it's done.
+    runManifest = RunManifest(os.path.join(bckpPath, ("data_" + datetime.today().strftime("%M-%d-%m-%Y") + ".jsonl")))
+    openLog = open(os.path.join(bckpPath, ("log_" + datetime.today().strftime("%M-%d-%m-%Y") + ".txt")), "w+",
+                   encoding='utf-8')
+    dateIndex = DateIndex.load(bckpPath, rebuild=args.reindex)
+    hashIndex = HashIndex(bckpPath)
+    deletions = DeletionQueue(bckpPath)
+    # Shared by every device, a connection per device would keep the others waiting for its write lock.
+    syncManifest = SyncManifest(bckpPath)
+    budget = ByteBudget(temp_budget or args.temp_budget * 1024 * 1024)
+    placementLock = threading.Lock()
+    # With --packs, the files are stored in daily packs instead of day folders.
+    dailyPacks = DailyPacks(bckpPath) if args.packs else None
+    perceptualIndex = None
+    if args.near_duplicates:
+        # NumPy and Pillow are only needed for this.
+        from perceptual import PerceptualIndex, dhash, perceptual_suffixes
+        perceptualIndex = PerceptualIndex(bckpPath)
+    # Files in the temp folder can be renamed into the backup folder instead of copied.
+    sameDevice = same_device(temp_directory, bckpPath)
+
+
+def start_pipeline():
+    """
+    Starts the stages of the run and queues the files left in the temp folder by a previous one.
+    :return: Array of the stages.
+    """
+    global pulledQueue
+    # Each file goes through pull -> metadata -> placement -> verification while the next ones are still being pulled.
+    pulledQueue, placeQueue, verifyQueue = new_queue(), new_queue(), new_queue()
+    stages = [Stage('metadata', pulled_photo, pulledQueue, placeQueue, on_error=stage_failed),
+              Stage('placement', place_photo, placeQueue, verifyQueue, on_error=stage_failed,
+                    threads=max(1, args.disk_writers)),
+              Stage('verification', verify_photo, verifyQueue, on_error=stage_failed)]
+    for stage in stages:
+        stage.start()
+    try:
+        queue_leftovers(placeQueue)
+    except BaseException:
+        # The stages are stopped here, the caller doesn't get them.
+        stop_stages(stages)
+        raise
+    return stages
+
+
+def queue_leftovers(placeQueue):
+    """
+    Queues for placement the files left in the temp folder by a previous run.
+    :param placeQueue: The inbox of the placement stage.
+    :return: None
+    """
+    from transfer import PullJournal
+
+    run_progress.stage('run', 'indexing')
+    # Files that can't be indexed are reported as failed (and left in the temp folder), the others are still backed up.
+    leftFailed = []
+    with run_metrics.timed('indexing', count=0):
+        leftImages = get_images(temp_directory, media_suffixes(), processes=os.cpu_count(),
+                                on_error=lambda photo, error: leftFailed.append([photo, error]))
+    run_metrics.add('indexing', count=len(leftImages))
+    # Where they were pulled from, so they're removed from their device once they're in the backup.
+    origins = PullJournal.origins(temp_directory)
+    for leftImage in leftImages + [photo for photo, error in leftFailed]:
+        origin = origins.get(os.path.normpath(os.path.join(leftImage.directory, leftImage.name)))
+        if origin is not None:
+            leftImage.device, leftImage.remote, leftImage.hash = origin
+    for photo, error in leftFailed:
+        record_failed(photo, error)
+    run_progress.add('listed', len(leftImages) + len(leftFailed))
+    run_progress.stage('run', 'backing up')
+    for leftImage in leftImages:
+        budget.acquire(leftImage.size)
+        placeQueue.put(leftImage)
+
+
+# Waits for the stages to handle every file given to them, `done` goes through all of them in order.
+def stop_stages(stages):
+    if stages:
+        pulledQueue.put(done)
+    for stage in stages:
+        stage.join()
+
+
+def abort_run(stages):
+    """
+    Ends a run that failed before finish_run, so nothing is left running or open: the stages stop once they've handled
+    the files already given to them, and the manifests, indexes and log are closed.
+    :param stages: Array of the stages of the run, maybe empty.
+    :return: None
+    """
+    stop_stages(stages)
+    for opened in [hashIndex, syncManifest, perceptualIndex, runManifest, deletions, openLog]:
+        if opened is not None:
+            opened.close()
+
+
+def finish_run(stages, devices, remove=False, failed_devices=None):
+    """
+    Waits for the stages to place every file, closes the indexes and manifests and removes the backed up files from
+    the devices.
+    :param stages: Array of the stages of the run, maybe empty.
+    :param devices: Array of [IP, ADB key, array of folders].
+    :param remove: Remove from the devices the files verified in the backup.
+    :param failed_devices: Dictionary {IP: error} of the devices that couldn't be backed up.
+    :return: RunResult
+    """
+    run_progress.stage('run', 'finishing')
+    stop_stages(stages)
+    hashIndex.close()
+    syncManifest.close()
+    if perceptualIndex is not None:
+        perceptualIndex.close()
+    runManifest.close()
+    removed = 0
+    try:
+        if remove:
+            from transfer import transport_errors
+
+            for remote_ip, adb_key, folders in devices:
+                # Their files stay queued for deletion, they're removed by the next backup that reaches them.
+                if remote_ip in (failed_devices or {}):
+                    continue
+                run_progress.stage(remote_ip, 'removing')
                 try:
-                    os.remove(os.path.join(element.directory, element.name))
-                    movedImages.append([element, movedFile])
-                    removedFile = initImages.pop(i)
-                    if not (removedFile == movedImages[-1][0]):
-                        print("Something went wrong with the internal management #5")
-                        openLog.write("Something went wrong with the internal management #5\n")
-                        sys.exit()
-                    else:
-                        print("There're copied " + str(len(movedImages)) + ", there're " + str(
-                            len(initImages)) + " left.")
-                except IsADirectoryError:
-                    print("Couldn't remove original file. #4")
-                    openLog.write("Couldn't remove original file. #4\n")
-                    sys.exit()
+                    removedNow = remove_backed_up(remote_ip, adb_key)
+                except transport_errors as e:
+                    print(f"---\nThe files of {remote_ip} couldn't be removed: {e}")
+                    openLog.write(f"The files of {remote_ip} couldn't be removed: {e}\n")
+                    run_progress.stage(remote_ip, 'failed')
+                    continue
+                removed += removedNow
+                print(f"---\n{removedNow} files removed from {remote_ip}.")
+                run_progress.stage(remote_ip, 'done')
+    finally:
+        deletions.close()
+        openLog.close()
+
+    print(f"---\n{run_metrics.report()}")
+    if args.metrics_json:
+        run_metrics.write_json(args.metrics_json)
+    if args.metrics_prom:
+        run_metrics.write_prometheus(args.metrics_prom)
+    run_progress.stage('run', 'done')
+    return RunResult(dict(runManifest.counts), removed, failed_devices, runManifest.manifest_file,
+                     run_metrics.summary())
+
+
+def pull_devices(devices, on_pulled=None):
+    """
+    Backs up every device at the same time, each one with its own temp folder.
+    :param devices: Array of [IP, ADB key, array of folders].
+    :param on_pulled: Called with each file pulled, by default it goes to the pipeline.
+    :return: Dictionary {IP: error} of the devices that couldn't be backed up.
+    """
+    limiter = RateLimiter(args.max_rate * 1024 * 1024) if args.max_rate else None
+    failed_devices = {}
+    with ThreadPoolExecutor(max_workers=len(devices)) as executor:
+        backups = [executor.submit(backup_device, remote_ip, adb_key, folders,
+                                   temp_directory if len(devices) == 1 else os.path.join(temp_directory, remote_ip),
+                                   limiter, None, args.resume, on_pulled)
+                   for remote_ip, adb_key, folders in devices]
+    for (remote_ip, adb_key, folders), backup_future in zip(devices, backups):
+        if backup_future.exception() is not None:
+            print(f"{remote_ip} couldn't be backed up: {backup_future.exception()}")
+            openLog.write(f"{remote_ip} couldn't be backed up: {backup_future.exception()}\n")
+            failed_devices[remote_ip] = str(backup_future.exception())
+            run_progress.stage(remote_ip, 'failed')
+            run_progress.message(f"{remote_ip} couldn't be backed up: {backup_future.exception()}")
+    return failed_devices
+
+
+def backup(config):
+    """
+    Backs up the devices of the configuration: their new files are pulled, placed in the backup folder, verified and
+    removed from the devices. As daemon, it runs until it's interrupted (KeyboardInterrupt).
+    The ADB, EXIF and crypto libraries are imported the first time they're needed, once per process.
+    :param config: The configuration of the run (see backup_config), or the parsed command line.
+    :return: RunResult
+    """
+    with run_lock:
+        devices = start_run(config)
+        stages = []
+        failed_devices = {}
+        try:
+            stages = start_pipeline()
+            if args.daemon:
+                limiter = RateLimiter(args.max_rate * 1024 * 1024) if args.max_rate else None
+                watch_devices(devices, args.probe_interval, limiter)
             else:
-                print("Something went wrong with the internal management #6")
-                openLog.write("Something went wrong with the internal management #6\n")
-                sys.exit()
-        else:
-            print("Something else needs to be prepared. Hmm... that's strange. #7")
-            openLog.write("Something else needs to be prepared. Hmm... that's strange. #7\n")
-            sys.exit()
+                failed_devices = pull_devices(devices)
+        except BaseException:
+            abort_run(stages)
+            raise
+        # As daemon, the files left are removed the next time their device appears.
+        return finish_run(stages, devices, remove=not args.keep_files and not args.daemon,
+                          failed_devices=failed_devices)
+
+
+def scan(config):
+    """
+    Lists the files that a backup would pull from each device (a dry run), without pulling them.
+    :param config: The configuration of the run (see backup_config).
+    :return: Dictionary {IP: array of AndroidPhoto-type objects}
+    """
+    from transfer import connect_device, device_serial
+
+    backup_path = config_paths(config)[0]
+    found = {}
+    for remote_ip, adb_key, folders in config_devices(config):
+        device = connect_device(remote_ip, load_signer(adb_key))
+        if device is None:
+            found[remote_ip] = []
+            continue
+        device_id = device_serial(device, remote_ip)
+        known = {}
+        if os.path.exists(os.path.join(backup_path, SyncManifest.manifest_name)):
+            manifest = SyncManifest(backup_path)
+            known = manifest.pulled(device_id)
+            manifest.close()
+        found[remote_ip] = list(new_files(device, folders, known, config.recursive, config.max_android_files or None))
+        device.close()
+    return found
+
+
+def pull(config):
+    """
+    Pulls the new files of the devices to the temp folder, without placing them in the backup folder (see organize).
+    :param config: The configuration of the run (see backup_config).
+    :return: RunResult
+    """
+    with run_lock:
+        devices = start_run(config, temp_budget=float('inf'))
+        try:
+            failed_devices = pull_devices(devices, on_pulled=lambda image: None)
+        except BaseException:
+            abort_run([])
+            raise
+        return finish_run([], devices, failed_devices=failed_devices)
+
+
+def organize(config):
+    """
+    Places in the backup folder the files waiting in the temp folder (pulled by pull or left by a killed run), without
+    connecting to any device. Their origin is read from the pull journals of the temp folder (see PullJournal.origins),
+    so unless keep_files is set, the ones verified in the backup are queued for deletion and removed from their device
+    by the next backup.
+    :param config: The configuration of the run (see backup_config).
+    :return: RunResult
+    """
+    with run_lock:
+        devices = start_run(config)
+        try:
+            stages = start_pipeline()
+        except BaseException:
+            abort_run([])
+            raise
+        return finish_run(stages, devices)
+
+
+def main():
+    cli_args = backup_parser.parse_args()
+    if cli_args.profile:
+        profiler = RunProfiler()
+        profiler.start()
+
+    print("---\nJABS, an open source backup system developed by Juan Cerdeño. Learn more at "
+          "https://www.github.com/ajuancer/jabs.\n---")
+    if cli_args.dry_run:
+        found = scan(cli_args)
+        for remote_ip, images in found.items():
+            for image in images:
+                print(f"{remote_ip}: {image.path + image.name} ({image.size} bytes)")
+        print(f"---\n{sum(len(images) for images in found.values())} files would be pulled.")
+        return
+    result = backup(cli_args)
+    if cli_args.profile:
+        profiler.save(cli_args.profile)
+        print(f"---\nProfile saved in {cli_args.profile}, open it with python -m pstats {cli_args.profile}.")
+    print(f"---\nAll done! Navigate to {bckpPath} and see the results.")
+    return result
 
-# Save results obtained. Should be done in a much proper way
-for p, movedF in enumerate(movedImages):
-    json.dump(movedF[0].toJSON(), openData, ensure_ascii=False, indent=4)  # save when something prints and close app
-    json.dump(movedF[1], openData, ensure_ascii=False, indent=4)  # save when something prints and close app
 
-print(f"---\nAll done! Navigate to {bckpPath} and see the results.")
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,349 @@
+import os
+import struct
+from datetime import datetime, timedelta, timezone
+
+# JPEG markers without a length field.
+standalone_markers = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8}
+exif_ifd_pointer = 0x8769
+datetime_original_tag = 0x9003
+# QuickTime/MP4 times are seconds since this date (UTC).
+mp4_epoch = datetime(1904, 1, 1, tzinfo=timezone.utc)
+png_signature = b'\x89PNG\r\n\x1a\n'
+
+
+def get_exif_datetime(path):
+    """
+    Gets the EXIF DateTimeOriginal of a JPEG file reading only its APP1 segment (usually the first few KB).
+    The full EXIF parser is only used if the segment can't be read by the fast one.
+    :param path: The route of the file.
+    :return: The date as a string (YYYY:MM:DD hh:mm:ss), or None.
+    """
+    try:
+        with open(path, 'rb') as f:
+            app1 = read_app1(f)
+        if app1 is None:
+            return None
+        return parse_datetime_original(app1)
+    except (ValueError, struct.error):
+        return _full_exif_datetime(path)
+
+
+def read_app1(f):
+    """
+    Walks the JPEG segment headers until the EXIF APP1 segment.
+    :param f: The file, opened in binary mode.
+    :return: The TIFF data of the segment (bytes), or None if the file has no EXIF.
+    """
+    if f.read(2) != b'\xff\xd8':
+        raise ValueError("Not a JPEG file.")
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            raise ValueError("Unexpected JPEG segment.")
+        if marker[1] == 0xFF:
+            # Fill byte.
+            f.seek(-1, 1)
+            continue
+        if marker[1] in standalone_markers:
+            continue
+        # Start of scan or end of image, the metadata is always before.
+        if marker[1] in (0xDA, 0xD9):
+            return None
+        length = struct.unpack('>H', f.read(2))[0]
+        if marker[1] == 0xE1:
+            data = f.read(length - 2)
+            if data.startswith(b'Exif\x00\x00'):
+                return data[6:]
+        else:
+            f.seek(length - 2, 1)
+
+
+def parse_datetime_original(tiff):
+    """
+    Looks for DateTimeOriginal in the EXIF sub-IFD of the given TIFF data.
+    :param tiff: The TIFF data of the APP1 segment.
+    :return: The date as a string, or None.
+    """
+    if tiff[:2] == b'II':
+        order = '<'
+    elif tiff[:2] == b'MM':
+        order = '>'
+    else:
+        raise ValueError("Wrong TIFF header.")
+    ifd0 = struct.unpack_from(order + 'I', tiff, 4)[0]
+    pointer = _find_tag(tiff, order, ifd0, exif_ifd_pointer)
+    if pointer is None:
+        return None
+    entry = _find_tag(tiff, order, struct.unpack_from(order + 'I', tiff, pointer + 8)[0], datetime_original_tag)
+    if entry is None:
+        return None
+    count = struct.unpack_from(order + 'I', tiff, entry + 4)[0]
+    # Values up to 4 bytes are stored in the entry itself.
+    offset = entry + 8 if count <= 4 else struct.unpack_from(order + 'I', tiff, entry + 8)[0]
+    value = tiff[offset:offset + count].split(b'\x00')[0]
+    return value.decode('ascii', errors='ignore') or None
+
+
+# Returns the offset of the IFD entry of the tag, or None.
+def _find_tag(tiff, order, ifd_offset, tag):
+    entries = struct.unpack_from(order + 'H', tiff, ifd_offset)[0]
+    for n in range(entries):
+        entry = ifd_offset + 2 + n * 12
+        if struct.unpack_from(order + 'H', tiff, entry)[0] == tag:
+            return entry
+    return None
+
+
+def _full_exif_datetime(path):
+    # Only needed when the fast path fails, so the exif library is imported then.
+    from exif import Image
+
+    try:
+        with open(path, 'rb') as f:
+            image = Image(f)
+            if image.has_exif:
+                to_format = getattr(image, 'datetime_original', None)
+                if isinstance(to_format, str):
+                    return to_format
+    except Exception:
+        pass
+    return None
+
+
+def get_mp4_datetime(path):
+    """
+    Gets the creation time of a MP4/MOV video from its moov/mvhd atom, seeking from atom header to atom header (the
+    moov atom may be at the end of the file, but the media data is never read).
+    :param path: The route of the file.
+    :return: The date as a string (YYYY:MM:DD hh:mm:ss, local time), or None.
+    """
+    with open(path, 'rb') as f:
+        end = os.fstat(f.fileno()).st_size
+        moov = _find_box(f, 0, end, b'moov')
+        if moov is None:
+            return None
+        mvhd = _find_box(f, moov[0], moov[1], b'mvhd')
+        if mvhd is None:
+            return None
+        f.seek(mvhd[0])
+        header = f.read(12)
+        # Version 1 has 64-bit times.
+        if header[0] == 1:
+            created = struct.unpack('>Q', header[4:12])[0]
+        else:
+            created = struct.unpack('>I', header[4:8])[0]
+    if not created:
+        return None
+    # In local time, as the EXIF dates.
+    return (mp4_epoch + timedelta(seconds=created)).astimezone().strftime('%Y:%m:%d %H:%M:%S')
+
+
+def get_heic_datetime(path):
+    """
+    Gets the EXIF DateTimeOriginal of a HEIC/HEIF image: the meta box tells where the Exif item is (iinf and iloc
+    boxes) and only that item is read.
+    :param path: The route of the file.
+    :return: The date as a string (YYYY:MM:DD hh:mm:ss), or None.
+    """
+    with open(path, 'rb') as f:
+        end = os.fstat(f.fileno()).st_size
+        meta = _find_box(f, 0, end, b'meta')
+        if meta is None:
+            return None
+        # Full box, its children are after version and flags.
+        start = meta[0] + 4
+        iinf = _find_box(f, start, meta[1], b'iinf')
+        iloc = _find_box(f, start, meta[1], b'iloc')
+        if iinf is None or iloc is None:
+            return None
+        f.seek(iinf[0])
+        exif_id = _exif_item_id(f.read(iinf[1] - iinf[0]))
+        if exif_id is None:
+            return None
+        f.seek(iloc[0])
+        location = _item_location(f.read(iloc[1] - iloc[0]), exif_id)
+        if location is None:
+            return None
+        f.seek(location[0])
+        item = f.read(location[1])
+    # The item starts with the offset of the TIFF header.
+    tiff_offset = struct.unpack('>I', item[:4])[0]
+    return parse_datetime_original(item[4 + tiff_offset:])
+
+
+def get_png_datetime(path):
+    """
+    Gets the EXIF DateTimeOriginal of a PNG image from its eXIf chunk, skipping the data of the other chunks.
+    :param path: The route of the file.
+    :return: The date as a string (YYYY:MM:DD hh:mm:ss), or None.
+    """
+    with open(path, 'rb') as f:
+        if f.read(8) != png_signature:
+            raise ValueError("Not a PNG file.")
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return None
+            length, chunk_type = struct.unpack('>I4s', header)
+            if chunk_type == b'eXIf':
+                return parse_datetime_original(f.read(length))
+            if chunk_type == b'IEND':
+                return None
+            # Data and CRC.
+            f.seek(length + 4, 1)
+
+
+# Returns (start of the content, end) of the first box of the given type between start and end, or None.
+def _find_box(f, start, end, box_type):
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        size, found_type = struct.unpack('>I4s', f.read(8))
+        header_size = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            # Up to the end of the file.
+            size = end - offset
+        if size < header_size:
+            raise ValueError("Wrong box size.")
+        if found_type == box_type:
+            return offset + header_size, offset + size
+        offset += size
+    return None
+
+
+# Returns the ID of the Exif item of an iinf box, or None.
+def _exif_item_id(iinf):
+    version = iinf[0]
+    entries = struct.unpack_from('>I' if version else '>H', iinf, 4)[0]
+    offset = 8 if version else 6
+    for n in range(entries):
+        size, box_type = struct.unpack_from('>I4s', iinf, offset)
+        if box_type == b'infe' and iinf[offset + 8] >= 2:
+            # Version 2 has 16-bit item IDs, version 3 32-bit ones.
+            if iinf[offset + 8] == 2:
+                item_id, _, item_type = struct.unpack_from('>HH4s', iinf, offset + 12)
+            else:
+                item_id, _, item_type = struct.unpack_from('>IH4s', iinf, offset + 12)
+            if item_type == b'Exif':
+                return item_id
+        offset += size
+    return None
+
+
+# Returns (offset, length) in the file of the first extent of the item, from an iloc box, or None.
+def _item_location(iloc, item_id):
+    version = iloc[0]
+    offset_size, length_size = iloc[4] >> 4, iloc[4] & 0xF
+    base_offset_size, index_size = iloc[5] >> 4, iloc[5] & 0xF
+    if version < 2:
+        items = struct.unpack_from('>H', iloc, 6)[0]
+        position = 8
+    else:
+        items = struct.unpack_from('>I', iloc, 6)[0]
+        position = 10
+    for n in range(items):
+        if version < 2:
+            found_id = struct.unpack_from('>H', iloc, position)[0]
+            position += 2
+        else:
+            found_id = struct.unpack_from('>I', iloc, position)[0]
+            position += 4
+        construction_method = 0
+        if version in (1, 2):
+            construction_method = struct.unpack_from('>H', iloc, position)[0] & 0xF
+            position += 2
+        # Data reference index.
+        position += 2
+        base_offset = _read_uint(iloc, position, base_offset_size)
+        position += base_offset_size
+        extents = struct.unpack_from('>H', iloc, position)[0]
+        position += 2
+        first = None
+        for extent in range(extents):
+            if version in (1, 2):
+                position += index_size
+            extent_offset = _read_uint(iloc, position, offset_size)
+            position += offset_size
+            extent_length = _read_uint(iloc, position, length_size)
+            position += length_size
+            if first is None:
+                first = (base_offset + extent_offset, extent_length)
+        # Only items stored in the file itself (not in the idat box) are read.
+        if found_id == item_id:
+            return first if construction_method == 0 else None
+    return None
+
+
+def _read_uint(data, offset, size):
+    return int.from_bytes(data[offset:offset + size], 'big') if size else 0
+
+
+# Date extractor of each file suffix. Each one gets the route of the file and returns the date as a string
+# (YYYY:MM:DD hh:mm:ss) or None, raising ValueError (or struct.error) if the file isn't what it should be.
+date_extractors = {}
+
+
+def register_extractor(suffixes, extractor):
+    """
+    Sets the function used to date the files with the given suffixes.
+    :param suffixes: Array of suffixes, with the dot (e.g. .mp4).
+    :param extractor: Function (route of the file -> date string or None).
+    :return: None
+    """
+    for suffix in suffixes:
+        date_extractors[suffix.lower()] = extractor
+
+
+register_extractor(['.jpg', '.jpeg'], get_exif_datetime)
+register_extractor(['.mp4', '.mov', '.m4v', '.3gp'], get_mp4_datetime)
+register_extractor(['.heic', '.heif'], get_heic_datetime)
+register_extractor(['.png'], get_png_datetime)
+
+
+# Returns the suffixes of the files that can be dated (and so backed up).
+def media_suffixes():
+    return tuple(date_extractors)
+
+
+def get_media_datetime(path):
+    """
+    Gets the date a file was taken with the extractor of its format, which reads only the headers it needs.
+    :param path: The route of the file.
+    :return: The date as a string (YYYY:MM:DD hh:mm:ss), or None if it can't be known from the file.
+    """
+    extractor = date_extractors.get(os.path.splitext(path)[1].lower())
+    if extractor is None:
+        return None
+    try:
+        return extractor(path)
+    except (ValueError, struct.error, IndexError):
+        return None
+
+
+def read_file_info(path):
+    """
+    Gets the metadata needed to date a file. It's run in the processes of the indexing pool, so the result is kept
+    compact (cheap to send back to the main process).
+    :param path: The route of the file.
+    :return: Tuple (size, creation time, EXIF date or None)
+    """
+    st = os.stat(path)
+    return st.st_size, st.st_ctime, get_media_datetime(path)
+
+
+def read_files_info(paths, processes=None):
+    """
+    Gets the metadata of many files in parallel, with a pool of processes (one per CPU by default).
+    :param paths: Array of routes.
+    :param processes: The number of processes.
+    :return: Array of tuples as returned by read_file_info, in the same order as paths.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    processes = processes or os.cpu_count() or 1
+    chunksize = max(1, min(512, len(paths) // (processes * 8)))
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(read_file_info, paths, chunksize=chunksize))
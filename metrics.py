@@ -0,0 +1,239 @@
+import collections
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+
+class Metrics(object):
+    """
+    Timers and counters of each stage of a run (connect, list, pull, exif, placement, verify, delete...), shared by
+    every thread. The seconds of a stage are the sum of the time spent in it by every thread, so with several threads
+    they can add up to more than the run itself.
+    """
+
+    def __init__(self):
+        super(Metrics, self).__init__()
+        self.started = time.monotonic()
+        # {stage: [items, seconds, bytes]}
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    # Starts again from zero, for a new run in the same process.
+    def reset(self):
+        with self.lock:
+            self.started = time.monotonic()
+            self.stages = {}
+
+    def add(self, stage, seconds=0., size=0, count=1):
+        with self.lock:
+            totals = self.stages.setdefault(stage, [0, 0., 0])
+            totals[0] += count
+            totals[1] += seconds
+            totals[2] += size or 0
+
+    @contextlib.contextmanager
+    def timed(self, stage, size=0, count=1):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(stage, time.monotonic() - start, size, count)
+
+    # Yields the items of the iterable, timing only what it takes to get each one.
+    def timed_iter(self, stage, iterable):
+        iterator = iter(iterable)
+        while True:
+            start = time.monotonic()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(stage, time.monotonic() - start, count=0)
+                return
+            self.add(stage, time.monotonic() - start)
+            yield item
+
+    def summary(self):
+        """
+        :return: Dictionary {'elapsed': seconds of the run, 'stages': {stage: {'items', 'seconds', 'bytes',
+        'items_per_s', 'bytes_per_s'}}}
+        """
+        with self.lock:
+            stages = {stage: list(totals) for stage, totals in self.stages.items()}
+        return {'elapsed': time.monotonic() - self.started,
+                'stages': {stage: {'items': items, 'seconds': seconds, 'bytes': size,
+                                   'items_per_s': items / seconds if seconds else None,
+                                   'bytes_per_s': size / seconds if seconds else None}
+                           for stage, (items, seconds, size) in stages.items()}}
+
+    def report(self):
+        # Table of the stages, as printed at the end of a run.
+        summary = self.summary()
+        lines = [f"Run time: {summary['elapsed']:.1f} s"]
+        for stage, totals in summary['stages'].items():
+            line = f"{stage:>12}: {totals['items']:8d} items {totals['seconds']:9.2f} s"
+            if totals['items_per_s'] is not None:
+                line += f" {totals['items_per_s']:9.1f} items/s"
+            if totals['bytes'] and totals['bytes_per_s'] is not None:
+                line += f" {totals['bytes_per_s'] / 1024 / 1024:8.1f} MB/s"
+            lines.append(line)
+        return "\n".join(lines)
+
+    def write_json(self, path):
+        _write_atomic(path, json.dumps(self.summary(), indent=4))
+
+    def write_prometheus(self, path):
+        """
+        Writes the metrics in the Prometheus text format, to be read by the textfile collector of node_exporter.
+        :param path: The route of the .prom file.
+        :return: None
+        """
+        summary = self.summary()
+        lines = ['# HELP jabs_run_seconds Time since the run started.', '# TYPE jabs_run_seconds gauge',
+                 f"jabs_run_seconds {summary['elapsed']:.3f}"]
+        for metric, key, description in (('items', 'items', 'Items done'), ('seconds', 'seconds', 'Time spent'),
+                                          ('bytes', 'bytes', 'Bytes processed')):
+            lines += [f'# HELP jabs_stage_{metric}_total {description} by each stage.',
+                      f'# TYPE jabs_stage_{metric}_total counter']
+            lines += [f'jabs_stage_{metric}_total{{stage="{stage}"}} {totals[key]}'
+                      for stage, totals in summary['stages'].items()]
+        _write_atomic(path, "\n".join(lines) + "\n")
+
+
+class Progress(object):
+    """
+    Progress line (rewritten in place with a carriage return) printed at most once every interval, so printing it
+    doesn't slow down what it's reporting.
+    """
+
+    def __init__(self, interval_s=0.5):
+        super(Progress, self).__init__()
+        self.interval_s = interval_s
+        self.last = 0.
+
+    # Prints the text if the last one was printed more than interval ago (or if it's forced).
+    def update(self, text, force=False):
+        now = time.monotonic()
+        if force or now - self.last >= self.interval_s:
+            self.last = now
+            print("\r" + text, end="")
+
+
+class ProgressBus(object):
+    """
+    Progress of the running backup (files listed, pulled and placed, bytes pulled, the stage of each device), sent by
+    every thread and read by a UI at its own pace. Events aren't queued one by one: counters are added up, and each
+    stage or file transfer replaces the previous one of the same device or file. So a poll gets everything that
+    happened since the last one in a single snapshot, however many events there were, and sending one is just a dict
+    update under a lock.
+    """
+
+    def __init__(self, max_messages=100):
+        super(ProgressBus, self).__init__()
+        self.counters = {}
+        # {source (e.g. a device IP): stage}
+        self.stages = {}
+        # {file: [bytes done, total bytes]} of the files being pulled.
+        self.transfers = {}
+        # Messages not polled yet, the oldest are dropped if nobody polls them.
+        self.messages = collections.deque(maxlen=max_messages)
+        self.lock = threading.Lock()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.stages = {}
+            self.transfers = {}
+            self.messages.clear()
+
+    def add(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def stage(self, source, stage):
+        with self.lock:
+            self.stages[source] = stage
+
+    def transfer(self, name, done_bytes, total_bytes):
+        with self.lock:
+            if done_bytes >= total_bytes:
+                self.transfers.pop(name, None)
+            else:
+                self.transfers[name] = [done_bytes, total_bytes]
+
+    def message(self, text):
+        with self.lock:
+            self.messages.append(text)
+
+    def poll(self):
+        """
+        Takes a snapshot of the progress. The messages are given only once, the rest is the current state.
+        :return: Dictionary {'counters': {counter: total}, 'stages': {source: stage}, 'transfers': {file: [bytes done,
+        total bytes]}, 'messages': [text, ...]}
+        """
+        with self.lock:
+            messages = list(self.messages)
+            self.messages.clear()
+            return {'counters': dict(self.counters), 'stages': dict(self.stages),
+                    'transfers': {name: list(sizes) for name, sizes in self.transfers.items()}, 'messages': messages}
+
+
+class RunProfiler(object):
+    """
+    cProfile of a whole run, including the threads started while it's enabled (each one gets its own profile and
+    they're merged when the stats are saved). Processes, like the ones of the indexing pool, aren't profiled.
+    From Python 3.12 cProfile is built on sys.monitoring, a single profile covers every thread and no other one can be
+    enabled at the same time.
+    """
+
+    def __init__(self):
+        super(RunProfiler, self).__init__()
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        if sys.version_info < (3, 12):
+            threading.setprofile(self.profile_thread)
+        self.profile_thread()
+
+    # Called by the first event of each new thread, it replaces itself with a profiler of the thread.
+    def profile_thread(self, *args):
+        import cProfile
+
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def save(self, path):
+        """
+        Stops profiling and saves the merged stats (readable with pstats or snakeviz).
+        :param path: The route of the stats file.
+        :return: pstats.Stats
+        """
+        import pstats
+
+        threading.setprofile(None)
+        with self.lock:
+            profiles = list(self.profiles)
+        profiles[0].disable()
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(path)
+        return stats
+
+
+def _write_atomic(path, text):
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(path + '.tmp', path)
+
+
+# Metrics of the running backup, used by every module.
+run_metrics = Metrics()
+# Progress of the running backup, for the GUI.
+run_progress = ProgressBus()
@@ -0,0 +1,309 @@
+import argparse
+import hashlib
+import io
+import json
+import os
+import sys
+import tarfile
+import threading
+
+from library import chunk_size, fsync_directory, member_separator, unique_name
+
+block_size = tarfile.BLOCKSIZE
+# Two empty blocks end a tar file.
+end_of_archive = b'\0' * (2 * block_size)
+
+
+class DailyPacks(object):
+    """
+    Storage of the backup folder where the files of each day are appended to a single (uncompressed) tar file,
+    year/month/day.tar, instead of being written one by one in the day folder. On slow drives (exFAT USB disks, SMB
+    shares) this turns many small writes, each with its own file creation and metadata update, into a few big
+    sequential ones.
+    Each pack has a sidecar index (day.tar.idx, JSON Lines) with the offset of every file, so any of them can be read
+    without walking the tar. A file is written to the index only once its data is fsync'd, and the pack is always a
+    valid tar file (readable by any tar tool). An index that doesn't reach the end of its pack (lost, or behind it
+    after a crash) is rebuilt from the tar headers.
+    The stored files are referred to as pack route + member_separator + name.
+    """
+
+    pack_suffix = '.tar'
+    index_suffix = '.idx'
+
+    def __init__(self, home_path):
+        super(DailyPacks, self).__init__()
+        self.home_path = home_path
+        # {pack route: {name: entry}}, loaded from the index of each pack the first time it's used.
+        self.indexes = {}
+        # Packs are written one file at a time, which is what makes the writes sequential.
+        self.lock = threading.Lock()
+
+    def pack_path(self, year, month, day):
+        return os.path.join(self.home_path, str(year), str(month), str(day) + self.pack_suffix)
+
+    # Returns the index of the pack, {name: {'name', 'offset', 'size', 'hash', 'mtime'}}.
+    def index(self, pack_path):
+        if pack_path not in self.indexes:
+            entries = {}
+            if os.path.exists(pack_path + self.index_suffix):
+                with open(pack_path + self.index_suffix, encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            # Half-written by a crash, its file is placed again.
+                            continue
+                        entries[entry['name']] = entry
+            if os.path.exists(pack_path) and _end(entries) + len(end_of_archive) != os.path.getsize(pack_path):
+                entries = self.rebuild(pack_path)
+            self.indexes[pack_path] = entries
+        return self.indexes[pack_path]
+
+    def rebuild(self, pack_path):
+        """
+        Rebuilds the index of a pack walking its tar headers, hashing every file again. A file cut by a crash is left
+        out, the next one is written over it.
+        :param pack_path: The route of the pack.
+        :return: The index, {name: entry}. It's also saved, replacing the old one atomically.
+        """
+        entries = {}
+        pack_size = os.path.getsize(pack_path)
+        with open(pack_path, 'rb') as pack:
+            try:
+                with tarfile.open(fileobj=pack, mode='r:') as tar:
+                    for member in tar:
+                        if not member.isfile() or member.offset_data + member.size > pack_size:
+                            break
+                        entries[member.name] = {'name': member.name, 'offset': member.offset_data,
+                                                'size': member.size, 'mtime': int(member.mtime)}
+            except tarfile.TarError:
+                # The rest of the pack was being written, what was read so far is kept.
+                pass
+            for entry in entries.values():
+                file_sha = hashlib.sha256()
+                pack.seek(entry['offset'])
+                remaining = entry['size']
+                while remaining:
+                    chunk = pack.read(min(chunk_size, remaining))
+                    file_sha.update(chunk)
+                    remaining -= len(chunk)
+                entry['hash'] = file_sha.hexdigest()
+        index_file = pack_path + self.index_suffix
+        with open(index_file + '.tmp', 'w', encoding='utf-8') as f:
+            for entry in sorted(entries.values(), key=lambda e: e['offset']):
+                f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(index_file + '.tmp', index_file)
+        return entries
+
+    def append(self, original_f, year, month, day, name=None, file_hash=None):
+        """
+        Appends a file to the pack of its day, hashing it while it's copied (see copy_hashed).
+        If the name is already taken in the pack by a different file, the hash is added to it (see unique_name).
+        :param original_f: The route of the file.
+        :param year: The year of the file.
+        :param month: The month of the file.
+        :param day: The day of the file.
+        :param name: The name in the pack. By default, the same of the original.
+        :param file_hash: The expected hash, needed to choose a new name if the name is taken.
+        :return: Array [stored route (pack + member_separator + name), SHA-256 hash of the original]
+        """
+        pack_path = self.pack_path(year, month, day)
+        name = name or os.path.basename(original_f)
+        with self.lock:
+            entries = self.index(pack_path)
+            if name in entries and file_hash is not None:
+                if entries[name]['hash'] == file_hash:
+                    return [pack_path + member_separator + name, file_hash]
+                name = unique_name(name, file_hash)
+            os.makedirs(os.path.dirname(pack_path), exist_ok=True)
+            created = not os.path.exists(pack_path)
+            # The new file goes where the last one ends, over the end of the archive.
+            end = _end(entries)
+            st = os.stat(original_f)
+            info = tarfile.TarInfo(name)
+            info.size = st.st_size
+            info.mtime = int(st.st_mtime)
+            info.mode = 0o644
+            header = info.tobuf(format=tarfile.PAX_FORMAT)
+            file_sha = hashlib.sha256()
+            with open(pack_path, 'r+b' if not created else 'wb') as pack, open(original_f, 'rb') as f_in:
+                pack.seek(end)
+                pack.write(header)
+                for chunk in iter(lambda: f_in.read(chunk_size), b''):
+                    file_sha.update(chunk)
+                    pack.write(chunk)
+                pack.write(b'\0' * (_padded(info.size) - info.size))
+                pack.write(end_of_archive)
+                pack.truncate()
+                pack.flush()
+                os.fsync(pack.fileno())
+            entry = {'name': name, 'offset': end + len(header), 'size': info.size, 'hash': file_sha.hexdigest(),
+                     'mtime': info.mtime}
+            with open(pack_path + self.index_suffix, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            if created:
+                fsync_directory(os.path.dirname(pack_path))
+            entries[name] = entry
+        return [pack_path + member_separator + name, entry['hash']]
+
+    def entry(self, stored_f):
+        pack_path, name = stored_f.split(member_separator, 1)
+        with self.lock:
+            return self.index(pack_path).get(name)
+
+    def open_member(self, stored_f):
+        """
+        Opens a stored file for reading, seeking straight to its data.
+        :param stored_f: The stored route (pack + member_separator + name).
+        :return: Binary file-like object, or None if it's not in the pack.
+        """
+        entry = self.entry(stored_f)
+        if entry is None:
+            return None
+        with open(stored_f.split(member_separator, 1)[0], 'rb') as pack:
+            pack.seek(entry['offset'])
+            return io.BytesIO(pack.read(entry['size']))
+
+    def read_chunks(self, stored_f):
+        # Yields the data of a stored file in chunks, without loading it in memory.
+        entry = self.entry(stored_f)
+        with open(stored_f.split(member_separator, 1)[0], 'rb') as pack:
+            pack.seek(entry['offset'])
+            remaining = entry['size']
+            while remaining:
+                chunk = pack.read(min(chunk_size, remaining))
+                if not chunk:
+                    raise EOFError(f"{stored_f} is cut.")
+                remaining -= len(chunk)
+                yield chunk
+
+    def verify(self, stored_f, size, file_hash=None):
+        """
+        Checks a stored file against the size and (if given) hash of the original, reading it again from the pack.
+        :return: Boolean
+        """
+        entry = self.entry(stored_f)
+        if entry is None or entry['size'] != size:
+            return False
+        if file_hash is None:
+            return True
+        file_sha = hashlib.sha256()
+        for chunk in self.read_chunks(stored_f):
+            file_sha.update(chunk)
+        return file_sha.hexdigest() == file_hash
+
+    def extract(self, stored_f, target_dir):
+        """
+        Copies a stored file out of its pack, with its modification time.
+        :param stored_f: The stored route (pack + member_separator + name).
+        :param target_dir: The folder where it's copied.
+        :return: The route of the copy.
+        """
+        entry = self.entry(stored_f)
+        target_f = os.path.join(target_dir, entry['name'])
+        with open(target_f, 'wb') as f:
+            for chunk in self.read_chunks(stored_f):
+                f.write(chunk)
+        os.utime(target_f, (entry['mtime'], entry['mtime']))
+        return target_f
+
+    def listing(self, prefix=''):
+        """
+        Lists the stored files as if they were in year/month/day folders.
+        :param prefix: Only the files under this route (e.g. 2021/3 is March, not October to December). The file name,
+        if given, can be just its beginning (e.g. 2021/3/14/IMG_).
+        :return: Generator of [virtual route, entry], sorted.
+        """
+        parts = [part for part in prefix.strip('/').split('/', 3) if part]
+        for year in sorted(_entries(self.home_path, directories=True), key=_number):
+            if not _under([year], parts):
+                continue
+            for month in sorted(_entries(os.path.join(self.home_path, year), directories=True), key=_number):
+                if not _under([year, month], parts):
+                    continue
+                packs = _entries(os.path.join(self.home_path, year, month), directories=False)
+                for pack in sorted((p for p in packs if p.endswith(self.pack_suffix)), key=_number):
+                    day = pack[:-len(self.pack_suffix)]
+                    if not _under([year, month, day], parts):
+                        continue
+                    folder = '/'.join([year, month, day])
+                    with self.lock:
+                        entries = list(self.index(os.path.join(self.home_path, year, month, pack)).values())
+                    for entry in sorted(entries, key=lambda e: e['name']):
+                        if len(parts) < 4 or entry['name'].startswith(parts[3]):
+                            yield [folder + '/' + entry['name'], entry]
+
+    # Returns the stored route of a virtual route (year/month/day/name).
+    def stored_route(self, virtual_route):
+        year, month, day, name = virtual_route.strip('/').split('/', 3)
+        return self.pack_path(year, month, day) + member_separator + name
+
+
+def _padded(size):
+    return (size + block_size - 1) // block_size * block_size
+
+
+# Where the data of the last file of a pack ends (before the end of the archive).
+def _end(entries):
+    return max((_padded(entry['offset'] + entry['size']) for entry in entries.values()), default=0)
+
+
+# Checks if the folders (year, month, day) are in the route, compared folder by folder.
+def _under(folders, parts):
+    return all(folder == part for folder, part in zip(folders, parts))
+
+
+def _number(name):
+    # Folders and packs sorted as numbers (2 before 10).
+    base = name.split('.')[0]
+    return (0, int(base), name) if base.isdigit() else (1, 0, name)
+
+
+def _entries(path, directories):
+    try:
+        with os.scandir(path) as entries:
+            return [entry.name for entry in entries if entry.is_dir() == directories]
+    except FileNotFoundError:
+        return []
+
+
+if __name__ == '__main__':
+    packs_parser = argparse.ArgumentParser(description='Lists and extracts the files of a backup stored in daily '
+                                                       'packs.')
+    packs_parser.add_argument('backup_dir', help='the backup folder.', type=str, metavar='backup_folder')
+    packs_commands = packs_parser.add_subparsers(dest='command', required=True)
+    ls_parser = packs_commands.add_parser('ls', help='list the files as year/month/day/name.')
+    ls_parser.add_argument('prefix', help='only the files under this route, e.g. 2021/3.', nargs='?', default='')
+    ls_parser.add_argument('-l', help='show also the size, date and hash.', action='store_true', dest='long')
+    extract_parser = packs_commands.add_parser('extract', help='copy files out of their packs.')
+    extract_parser.add_argument('routes', help='the routes of the files, as listed by ls.', nargs='+')
+    extract_parser.add_argument('--to', help='the folder where they\'re copied.', type=str, default='.')
+    cat_parser = packs_commands.add_parser('cat', help='write a file to the standard output.')
+    cat_parser.add_argument('route', help='the route of the file, as listed by ls.')
+    packs_args = packs_parser.parse_args()
+
+    dailyPacks = DailyPacks(packs_args.backup_dir)
+    if packs_args.command == 'ls':
+        for virtualRoute, packEntry in dailyPacks.listing(packs_args.prefix.strip('/')):
+            if packs_args.long:
+                print(f"{packEntry['size']:>12} {packEntry['mtime']:>11} {packEntry['hash'][:16]} {virtualRoute}")
+            else:
+                print(virtualRoute)
+    elif packs_args.command == 'extract':
+        os.makedirs(packs_args.to, exist_ok=True)
+        for virtualRoute in packs_args.routes:
+            storedRoute = dailyPacks.stored_route(virtualRoute)
+            if dailyPacks.entry(storedRoute) is None:
+                print(f"{virtualRoute} isn't in the backup.")
+                continue
+            print(dailyPacks.extract(storedRoute, packs_args.to))
+    else:
+        storedRoute = dailyPacks.stored_route(packs_args.route)
+        if dailyPacks.entry(storedRoute) is None:
+            sys.exit(f"{packs_args.route} isn't in the backup.")
+        for packChunk in dailyPacks.read_chunks(storedRoute):
+            sys.stdout.buffer.write(packChunk)
@@ -0,0 +1,194 @@
+import argparse
+import itertools
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from library import Database, member_separator
+
+# Files that can be decoded to compute their perceptual hash.
+perceptual_suffixes = ('.jpg', '.jpeg', '.png')
+# Bits set in each byte, for NumPy versions without bitwise_count.
+_byte_counts = np.array([bin(n).count('1') for n in range(256)], dtype=np.uint8)
+
+
+def dhash(path, hash_size=8):
+    """
+    Gets the difference hash of an image: it's shrunk to (hash_size + 1) x hash_size grey pixels and each bit tells if
+    a pixel is brighter than the one at its left. Copies of the same photo (resized, recompressed, re-shared) get the
+    same or a very close hash. JPEG files are decoded at a reduced scale, so it's much faster than a full decode.
+    :param path: The route of the image.
+    :param hash_size: The side of the grid, 8 gives 64-bit hashes.
+    :return: The hash (int), or None if the file can't be decoded.
+    """
+    try:
+        with Image.open(path) as image:
+            image.draft('L', (hash_size * 8, hash_size * 8))
+            image = ImageOps.exif_transpose(image).convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR)
+            pixels = np.asarray(image, dtype=np.int16)
+    except (OSError, UnidentifiedImageError, ValueError):
+        return None
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def popcount(values):
+    # Number of bits set of each uint64 of the array.
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    return _byte_counts[np.ascontiguousarray(values).view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def near_pairs(hashes, max_distance):
+    """
+    Finds every pair of hashes within the given Hamming distance without comparing all of them. Hashes are split in
+    max_distance + 3 blocks, so two hashes within the distance have at least 3 equal blocks: for each combination of
+    3 blocks, the hashes are sorted by those blocks and only the ones where they're equal are compared.
+    :param hashes: NumPy array of uint64 hashes.
+    :param max_distance: The maximum number of different bits.
+    :return: NumPy array of pairs of indexes [[i, j], ...] with i < j.
+    """
+    bounds = np.linspace(0, 64, max_distance + 4).astype(int)
+    block_masks = [((1 << int(end)) - 1) ^ ((1 << int(start)) - 1) for start, end in zip(bounds[:-1], bounds[1:])]
+    found = [np.empty((0, 2), dtype=np.int64)]
+    for blocks in itertools.combinations(block_masks, 3):
+        keys = hashes & np.uint64(blocks[0] | blocks[1] | blocks[2])
+        order = np.argsort(keys)
+        sorted_keys = keys[order]
+        # Hashes with the same key are together, every pair of them is compared (first the adjacent ones, then the
+        # ones 2 positions away...).
+        shift = 1
+        while shift < len(hashes):
+            same = sorted_keys[shift:] == sorted_keys[:-shift]
+            if not same.any():
+                break
+            first, second = order[:-shift][same], order[shift:][same]
+            close = popcount(hashes[first] ^ hashes[second]) <= max_distance
+            found.append(np.sort(np.stack([first[close], second[close]], axis=1), axis=1))
+            shift += 1
+    return np.unique(np.concatenate(found), axis=0)
+
+
+class PerceptualIndex(Database):
+    """
+    Perceptual hashes of the photos of the backup folder, to find near-duplicates (burst shots, re-shared copies...)
+    that the content hash can't. They're stored in SQLite and loaded in a NumPy array, where a search is a single
+    vectorized XOR and popcount over every photo.
+    """
+
+    index_name = '.jabs_phash.db'
+
+    def __init__(self, home_path, index_file=None, commit_every=50):
+        super(PerceptualIndex, self).__init__(index_file or os.path.join(home_path, self.index_name),
+                                              'CREATE TABLE IF NOT EXISTS phash (path TEXT PRIMARY KEY, hash TEXT)',
+                                              commit_every)
+        self.home_path = home_path
+        rows = self.query('SELECT path, hash FROM phash')
+        # Routes relative to the backup folder, in the same order as the hashes.
+        self.paths = [path for path, phash in rows]
+        self.hashes = np.array([int(phash, 16) for path, phash in rows], dtype=np.uint64)
+        self.count = len(rows)
+        self.array_lock = threading.Lock()
+
+    def add(self, stored_f, phash):
+        relative = os.path.relpath(stored_f, self.home_path)
+        self.write('INSERT OR REPLACE INTO phash VALUES (?, ?)', (relative, f'{phash:016x}'))
+        with self.array_lock:
+            # The array grows by doubling, so adding is cheap.
+            if self.count == len(self.hashes):
+                self.hashes = np.resize(self.hashes, max(1024, self.count * 2))
+            self.hashes[self.count] = phash
+            self.paths.append(relative)
+            self.count += 1
+
+    def indexed(self):
+        with self.array_lock:
+            return set(self.paths)
+
+    def near(self, phash, max_distance):
+        """
+        Finds the photos that look like the given one.
+        :param phash: The perceptual hash of the photo.
+        :param max_distance: The maximum number of different bits.
+        :return: Array of [route of the photo, distance], the closest first.
+        """
+        with self.array_lock:
+            hashes = self.hashes[:self.count]
+            paths = self.paths
+        distances = popcount(hashes ^ np.uint64(phash))
+        found = [[os.path.join(self.home_path, paths[n]), int(distances[n])]
+                 for n in np.flatnonzero(distances <= max_distance)]
+        return sorted([f for f in found if os.path.exists(f[0].split(member_separator, 1)[0])], key=lambda f: f[1])
+
+    def groups(self, max_distance):
+        """
+        Groups the photos of the index that look the same (if A is like B and B like C, the three are a group).
+        :param max_distance: The maximum number of different bits between two photos of a group.
+        :return: Array of groups, each one an array of routes.
+        """
+        with self.array_lock:
+            hashes = self.hashes[:self.count].copy()
+            paths = list(self.paths)
+        parent = list(range(len(paths)))
+
+        def root(n):
+            while parent[n] != n:
+                parent[n] = parent[parent[n]]
+                n = parent[n]
+            return n
+
+        for first, second in near_pairs(hashes, max_distance):
+            parent[root(first)] = root(second)
+        groups = {}
+        for n, path in enumerate(paths):
+            groups.setdefault(root(n), []).append(os.path.join(self.home_path, path))
+        return [sorted(group) for group in groups.values() if len(group) > 1]
+
+
+def index_backup(perceptual_index, processes=None):
+    """
+    Adds to the index the photos of the backup folder that aren't in it yet, hashing them in parallel.
+    :param perceptual_index: PerceptualIndex of the backup folder.
+    :param processes: The number of processes, one per CPU by default.
+    :return: The number of photos added.
+    """
+    indexed = perceptual_index.indexed()
+    to_hash = []
+    for root, dirs, files in os.walk(perceptual_index.home_path):
+        for file in files:
+            path = os.path.join(root, file)
+            if (file.lower().endswith(perceptual_suffixes)
+                    and os.path.relpath(path, perceptual_index.home_path) not in indexed):
+                to_hash.append(path)
+    processes = processes or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        hashes = executor.map(dhash, to_hash, chunksize=max(1, min(64, len(to_hash) // (processes * 8))))
+        added = 0
+        for path, phash in zip(to_hash, hashes):
+            if phash is not None:
+                perceptual_index.add(path, phash)
+                added += 1
+    return added
+
+
+if __name__ == '__main__':
+    perceptual_parser = argparse.ArgumentParser(description='Lists the groups of photos of a backup folder that look '
+                                                            'the same.')
+    perceptual_parser.add_argument('backup_dir', help='the backup folder.', type=str, metavar='backup_folder')
+    perceptual_parser.add_argument('--distance', help='the maximum number of different bits (of 64) of two photos '
+                                                      'that look the same.', type=int, default=6)
+    perceptual_parser.add_argument('--build', help='hash first the photos of the backup folder not in the index.',
+                                   action='store_true')
+    perceptual_args = perceptual_parser.parse_args()
+
+    perceptualIndex = PerceptualIndex(perceptual_args.backup_dir)
+    if perceptual_args.build:
+        print(f"---\n{index_backup(perceptualIndex)} photos added to the index.")
+    similarGroups = perceptualIndex.groups(perceptual_args.distance)
+    for similarGroup in similarGroups:
+        print("---\n" + "\n".join(similarGroup))
+    print(f"---\n{len(similarGroups)} groups of photos that look the same, of {perceptualIndex.count} photos.")
+    perceptualIndex.close()
@@ -0,0 +1,113 @@
+import queue
+import threading
+import time
+
+from metrics import run_metrics
+
+# Put in a queue to tell the stage reading it that there's nothing else to come.
+done = object()
+
+
+class ByteBudget(object):
+    """
+    Limits the bytes that can be waiting in the temp folder at the same time.
+    Pulls acquire the size of the file before starting and it's released once the file leaves the temp folder, so a
+    slow backup drive makes the pulls wait instead of filling the disk.
+    """
+
+    def __init__(self, max_bytes):
+        super(ByteBudget, self).__init__()
+        self.max_bytes = max_bytes
+        self.in_use = 0
+        self.condition = threading.Condition()
+
+    # Blocks until there's room for the given bytes. A file bigger than the budget is let in when nothing else is.
+    def acquire(self, size):
+        size = size or 0
+        with self.condition:
+            while self.in_use and self.in_use + size > self.max_bytes:
+                self.condition.wait()
+            self.in_use += size
+
+    def release(self, size):
+        with self.condition:
+            self.in_use = max(0, self.in_use - (size or 0))
+            self.condition.notify_all()
+
+
+class RateLimiter(object):
+    """
+    Token bucket limiting the bytes per second pulled by every worker that shares it (of one or several devices).
+    """
+
+    def __init__(self, max_rate):
+        super(RateLimiter, self).__init__()
+        self.max_rate = max_rate
+        self.allowance = max_rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Takes the given bytes from the bucket, sleeping if they go over the rate.
+    def consume(self, size):
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.max_rate, self.allowance + (now - self.last) * self.max_rate) - size
+            self.last = now
+            wait = -self.allowance / self.max_rate if self.allowance < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class Stage(object):
+    """
+    Step of the backup pipeline running on its own threads.
+    Takes each item of the inbox, gives it to the function and puts the result (if any) in the outbox. When it gets
+    `done`, it's passed on (once every thread of the stage has finished) and the threads end.
+    The time spent on each item is added to the metrics of the run, under the name of the stage.
+    """
+
+    def __init__(self, name, function, inbox, outbox=None, on_error=None, threads=1):
+        super(Stage, self).__init__()
+        self.name = name
+        self.function = function
+        self.inbox = inbox
+        self.outbox = outbox
+        self.on_error = on_error
+        self.running = threads
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self.run, name=f'{name}-{n}', daemon=True) for n in range(threads)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def run(self):
+        while True:
+            item = self.inbox.get()
+            if item is done:
+                # Left for the other threads of the stage.
+                self.inbox.put(done)
+                with self.lock:
+                    self.running -= 1
+                    last = self.running == 0
+                if last and self.outbox is not None:
+                    self.outbox.put(done)
+                break
+            try:
+                with run_metrics.timed(self.name):
+                    result = self.function(item)
+            except Exception as e:
+                if self.on_error is None:
+                    raise
+                self.on_error(item, e)
+                continue
+            if self.outbox is not None and result is not None:
+                self.outbox.put(result)
+
+
+def new_queue(max_items=64):
+    return queue.Queue(maxsize=max_items)
@@ -0,0 +1,620 @@
+import io
+import itertools
+import json
+import os
+import posixpath
+import queue
+import shutil
+import socket
+import stat
+import tarfile
+import threading
+import time
+
+from adb_shell import exceptions
+from adb_shell.adb_device import AdbDeviceTcp
+
+from library import hash_file
+from metrics import run_metrics
+
+# Errors after which the connection is considered lost and should be opened again.
+transport_errors = (OSError, exceptions.TcpTimeoutException, exceptions.InvalidCommandError,
+                    exceptions.InvalidResponseError)
+# Longest shell command sent at once, older adbd versions don't accept messages over 4 KB.
+max_command_length = 4000
+
+
+# Object for reduced info. files.
+class AndroidPhoto(object):
+    """docstring for androidPhoto."""
+
+    def __init__(self):
+        super(AndroidPhoto, self).__init__()
+        self.name = None
+        self.path = None
+        self.size = None
+        self.mtime = None
+        self.hash = None
+        # Serial number (or IP) of the device and local route, once it's pulled.
+        self.device = None
+        self.local_path = None
+        # Folder of the temp folder where the file is pulled, the device folder (see _android_file).
+        self.subfolder = ''
+
+
+def connect_device(remote_ip, signer, port=5555, timeout_s=100.):
+    """
+    Opens (and authenticates) an ADB connection to the given device.
+    :param remote_ip: The IP of the device.
+    :param signer: The PythonRSASigner of the ADB key.
+    :param port: The TCP port where the device is listening.
+    :param timeout_s: Transport and auth timeout, in seconds.
+    :return: The connected AdbDeviceTcp, or None if the connection was refused.
+    """
+    device = AdbDeviceTcp(remote_ip, port, default_transport_timeout_s=timeout_s)
+    with run_metrics.timed('connect'):
+        connected = device.connect(rsa_keys=[signer], auth_timeout_s=timeout_s)
+    return device if connected else None
+
+
+def probe_device(remote_ip, port=5555, timeout_s=1.):
+    """
+    Checks if the device is on the network, opening (and closing) a plain TCP connection to its ADB port. It's much
+    cheaper than connecting through ADB, there's no auth.
+    :param remote_ip: The IP of the device.
+    :param port: The TCP port where the device is listening.
+    :param timeout_s: How long to wait for the device, in seconds.
+    :return: Boolean
+    """
+    try:
+        socket.create_connection((remote_ip, port), timeout=timeout_s).close()
+        return True
+    except OSError:
+        return False
+
+
+class SessionPool(object):
+    """
+    Authenticated ADB connections kept open between backups, so a device that comes back is backed up without
+    connecting (and authenticating) again. Connections are taken and given back by IP; an idle one is checked with
+    a cheap shell command before it's reused, and the broken ones are closed.
+    """
+
+    def __init__(self, timeout_s=100.):
+        super(SessionPool, self).__init__()
+        self.timeout_s = timeout_s
+        # {IP: [idle AdbDeviceTcp]}
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    # Returns an idle connection to the device (or a new one), None if the connection was refused.
+    def acquire(self, remote_ip, signer):
+        while True:
+            with self.lock:
+                idle = self.idle.get(remote_ip)
+                device = idle.pop() if idle else None
+            if device is None:
+                return connect_device(remote_ip, signer, timeout_s=self.timeout_s)
+            try:
+                device.shell('true', transport_timeout_s=5, read_timeout_s=5)
+                return device
+            except transport_errors:
+                _close(device)
+
+    def release(self, remote_ip, device):
+        if device is None:
+            return
+        if not device.available:
+            _close(device)
+            return
+        with self.lock:
+            self.idle.setdefault(remote_ip, []).append(device)
+
+    # Closes the idle connections to the device (e.g. once it's left the network).
+    def discard(self, remote_ip):
+        with self.lock:
+            idle = self.idle.pop(remote_ip, [])
+        for device in idle:
+            _close(device)
+
+    def close(self):
+        for remote_ip in list(self.idle):
+            self.discard(remote_ip)
+
+
+class PullWorker(threading.Thread):
+    """
+    Pulls files from a shared work queue through its own ADB connection.
+    A pull is right if the size (and the hash, if it was got from the device) is the same of the remote file.
+    If the connection fails, it's opened again and the same file retried, so one worker going down doesn't stop the
+    others. With a SessionPool, the connection is taken from it and given back once there's nothing else to pull.
+    """
+
+    def __init__(self, remote_ip, signer, work, destination, device=None, retries=3, progress_callback=None,
+                 on_pulled=None, budget=None, limiter=None, sessions=None):
+        super(PullWorker, self).__init__(daemon=True)
+        self.remote_ip = remote_ip
+        self.signer = signer
+        self.work = work
+        self.destination = destination
+        self.device = device
+        self.retries = retries
+        self.progress_callback = progress_callback
+        self.on_pulled = on_pulled
+        self.budget = budget
+        self.limiter = limiter
+        self.sessions = sessions
+        self.pulled = []
+        self.failed = []
+        # Files of the current item already pulled and given to on_pulled.
+        self.checked = []
+
+    def run(self):
+        while True:
+            item = self.work.get()[2]
+            # No more files to come.
+            if item is None:
+                break
+            # A batch of small files of the same folder, pulled as a single tar stream.
+            images = item if isinstance(item, list) else [item]
+            if self.budget is not None:
+                self.budget.acquire(sum(image.size or 0 for image in images))
+            start = time.monotonic()
+            self.checked = []
+            try:
+                if isinstance(item, list):
+                    failed = self.pull_tar(images)
+                else:
+                    failed = [] if self.pull(item) else [item]
+            except Exception as e:
+                # E.g. the file was deleted from the device after it was listed. The worker goes on with the next one.
+                print(f"\r\rPulling {images[0].name if len(images) == 1 else images[0].path} failed "
+                      f"({type(e).__name__}: {e}).")
+                failed = [image for image in images if image not in self.checked]
+            run_metrics.add('pull', time.monotonic() - start, sum(image.size or 0 for image in images
+                                                                  if image not in failed), len(images) - len(failed))
+            self.pulled.extend(image for image in images if image not in failed)
+            self.failed.extend(failed)
+            if self.budget is not None:
+                self.budget.release(sum(image.size or 0 for image in failed))
+        self.release()
+
+    # Pulls one file, reconnecting and retrying after transport errors. Returns boolean.
+    def pull(self, image):
+        local_path = os.path.join(self.destination, image.subfolder, image.name)
+        # Where the file is written until it's complete. What's in it is kept to resume the pull.
+        part_path = local_path + '.part'
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        for attempt in range(self.retries + 1):
+            try:
+                self.connect()
+                offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+                if 0 < offset < image.size:
+                    self.resume(image, part_path, offset)
+                elif offset != image.size or not os.path.exists(part_path):
+                    self.device.pull(image.path + image.name, part_path, progress_callback=self.progress(),
+                                     transport_timeout_s=100, read_timeout_s=100)
+                if os.path.getsize(part_path) == image.size:
+                    os.replace(part_path, local_path)
+                    if self.check(image, local_path):
+                        return True
+                # Wrong size or content, the next attempt starts again.
+                for path in (part_path, local_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+            except transport_errors as e:
+                print(f"\r\rPulling {image.name} failed ({type(e).__name__}), "
+                      f"attempt {attempt + 1}/{self.retries + 1}.")
+                self.close()
+                time.sleep(min(2 ** attempt, 30))
+        return False
+
+    # Appends the rest of the file (from offset) to the partial one, streamed by tail through the shell.
+    def resume(self, image, part_path, offset):
+        print(f"\r\rResuming {image.name} from {offset} bytes.")
+        with open(part_path, 'ab') as f:
+            for chunk in self.stream('tail -c +' + str(offset + 1) + ' ' + shell_quote(image.path + image.name)):
+                f.write(chunk)
+
+    def pull_tar(self, images):
+        """
+        Pulls files of the same folder with a single tar command, unpacking the stream while it arrives.
+        Files missing from the stream (or all of them, if tar isn't available on the device) are pulled one by one.
+        :param images: Array of AndroidPhoto-type objects, all of them of the same folder.
+        :return: Array of the files that couldn't be pulled.
+        """
+        pending = {image.name: image for image in images}
+        local_folder = os.path.join(self.destination, images[0].subfolder)
+        os.makedirs(local_folder, exist_ok=True)
+        for attempt in range(self.retries + 1):
+            try:
+                self.connect()
+                for command in chunk_arguments('cd ' + shell_quote(images[0].path) + ' && tar -cf -',
+                                               [shell_quote(name) for name in pending]):
+                    stream = io.BufferedReader(_ChunkReader(self.stream(command)))
+                    with tarfile.open(fileobj=stream, mode='r|') as tar:
+                        for member in tar:
+                            image = pending.get(member.name)
+                            if image is None or not member.isfile() or member.size != image.size:
+                                continue
+                            local_path = os.path.join(local_folder, image.name)
+                            with open(local_path, 'wb') as f:
+                                shutil.copyfileobj(tar.extractfile(member), f, 1024 * 1024)
+                            if self.check(image, local_path):
+                                del pending[image.name]
+                break
+            except tarfile.TarError:
+                # Not a tar stream, tar isn't available on the device.
+                break
+            except transport_errors as e:
+                print(f"\r\rPulling {len(pending)} files of {images[0].path} failed ({type(e).__name__}), "
+                      f"attempt {attempt + 1}/{self.retries + 1}.")
+                self.close()
+                time.sleep(min(2 ** attempt, 30))
+        return [image for image in pending.values() if not self.pull(image)]
+
+    # Runs a shell command yielding its (binary) output, within the rate limit.
+    def stream(self, command):
+        for chunk in self.device.streaming_shell(command, transport_timeout_s=100, read_timeout_s=100, decode=False):
+            if self.limiter is not None:
+                self.limiter.consume(len(chunk))
+            yield chunk
+
+    # Returns the progress callback of a pull, which also keeps it within the rate limit. adb-shell gives the size of
+    # each chunk, progress_callback gets the bytes written so far.
+    def progress(self):
+        if self.limiter is None and self.progress_callback is None:
+            return None
+        written = [0]
+
+        def progress_callback(device_path, chunk_bytes, total_bytes):
+            written[0] += chunk_bytes
+            if self.limiter is not None:
+                self.limiter.consume(chunk_bytes)
+            if self.progress_callback is not None:
+                self.progress_callback(device_path, written[0], total_bytes)
+
+        return progress_callback
+
+    # Checks a pulled file against the size (and hash) of the remote one. Returns boolean.
+    def check(self, image, local_path):
+        if image.size != os.path.getsize(local_path) or (image.hash is not None and
+                                                          hash_file(local_path) != image.hash):
+            return False
+        image.local_path = local_path
+        if self.on_pulled is not None:
+            self.on_pulled(image)
+        self.checked.append(image)
+        print("\r\r" + image.name + " is now in the temp folder.")
+        return True
+
+    def connect(self):
+        if self.device is None:
+            if self.sessions is not None:
+                self.device = self.sessions.acquire(self.remote_ip, self.signer)
+            else:
+                self.device = connect_device(self.remote_ip, self.signer)
+            if self.device is None:
+                raise ConnectionError(f"Couldn't connect to {self.remote_ip}.")
+
+    # Gives the connection back to the session pool, if any, or closes it.
+    def release(self):
+        if self.sessions is not None:
+            self.sessions.release(self.remote_ip, self.device)
+            self.device = None
+        self.close()
+
+    def close(self):
+        if self.device is not None:
+            _close(self.device)
+            self.device = None
+
+
+class PullPool(object):
+    """
+    Pool of PullWorker threads, each one with its own ADB connection to the same device.
+    Files can be added while the workers are already pulling (e.g. while the device is still being listed). The
+    largest files waiting are always pulled first, so the last ones to finish are the small ones.
+    """
+
+    def __init__(self, remote_ip, signer, destination, workers=1, device=None, retries=3, progress_callback=None,
+                 on_pulled=None, budget=None, limiter=None, sessions=None):
+        """
+        :param remote_ip: The IP of the device where the files are located.
+        :param signer: The PythonRSASigner of the ADB key.
+        :param destination: The local folder where the files are pulled.
+        :param workers: The number of simultaneous connections.
+        :param device: An already connected AdbDeviceTcp, reused by the first worker.
+        :param retries: The number of retries of each file after a transport error.
+        :param progress_callback: Called while pulling, only used if there's a single worker.
+        :param on_pulled: Called with each AndroidPhoto-type object once it's pulled (from the worker thread).
+        :param budget: ByteBudget acquired before each pull. It's released here only if the pull fails.
+        :param limiter: RateLimiter shared by the workers (and maybe by the pools of other devices).
+        :param sessions: SessionPool where the workers take their connections from (and give them back).
+        """
+        super(PullPool, self).__init__()
+        # Items are (-size, order, file), so the biggest goes first.
+        self.work = queue.PriorityQueue()
+        self.count = itertools.count()
+        self.workers = [PullWorker(remote_ip, signer, self.work, destination, device=device if n == 0 else None,
+                                   retries=retries, progress_callback=progress_callback if workers == 1 else None,
+                                   on_pulled=on_pulled, budget=budget, limiter=limiter, sessions=sessions)
+                        for n in range(max(1, workers))]
+        for worker in self.workers:
+            worker.start()
+
+    def put(self, image):
+        self.work.put((-(image.size or 0), next(self.count), image))
+
+    # Adds small files of the same folder, pulled together as a tar stream.
+    def put_tar(self, images):
+        self.work.put((-sum(image.size or 0 for image in images), next(self.count), list(images)))
+
+    def finish(self):
+        """
+        Waits until every file added is pulled.
+        :return: Array [pulled files, failed files]
+        """
+        # Ordered after any file, one for each worker.
+        for worker in self.workers:
+            self.work.put((float('inf'), next(self.count), None))
+        for worker in self.workers:
+            worker.join()
+        pulled = [image for worker in self.workers for image in worker.pulled]
+        failed = [image for worker in self.workers for image in worker.failed]
+        # Files left in the queue if the workers died.
+        while not self.work.empty():
+            item = self.work.get_nowait()[2]
+            if item is not None:
+                failed.extend(item if isinstance(item, list) else [item])
+        return [pulled, failed]
+
+
+class PullJournal(object):
+    """
+    Journal (JSON Lines, append-only) of the files queued and pulled in a run, kept in the temp folder.
+    If a run is killed, the next one can resume it from the journal without listing the device again: the files
+    queued and not pulled are queued again, and the partial ones continue from the bytes already in their .part file.
+    """
+
+    journal_name = '.jabs_journal.jsonl'
+
+    def __init__(self, temp_path, resume=False):
+        super(PullJournal, self).__init__()
+        self.temp_path = temp_path
+        self.journal_file = os.path.join(temp_path, self.journal_name)
+        self.lock = threading.Lock()
+        records = self.read(self.journal_file)
+        self.records = records if resume else []
+        self.journal = open(self.journal_file, 'a' if resume else 'w', encoding='utf-8')
+        if not resume:
+            # The files pulled by the previous run and still in the temp folder keep their origin (see origins).
+            for record in records:
+                if (record['event'] == 'pulled' and record.get('local') is not None
+                        and os.path.exists(os.path.join(temp_path, record['local']))):
+                    self.write(record)
+
+    @staticmethod
+    def read(journal_file):
+        if not os.path.exists(journal_file):
+            return []
+        records = []
+        with open(journal_file, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # Last line of a killed run, half-written.
+                    pass
+        return records
+
+    def pending(self):
+        """
+        Gets the files queued but not pulled by the previous run.
+        :return: Array of AndroidPhoto-type objects.
+        """
+        queued = {}
+        for record in self.records:
+            if record['event'] == 'queued':
+                image = AndroidPhoto()
+                image.__dict__.update(record['file'])
+                queued[image.path + image.name] = image
+            elif record['event'] == 'pulled':
+                queued.pop(record['path'], None)
+        return list(queued.values())
+
+    def queued(self, image):
+        self.write({'event': 'queued', 'file': image.__dict__})
+
+    def pulled(self, image):
+        self.write({'event': 'pulled', 'path': image.path + image.name, 'device': image.device, 'hash': image.hash,
+                    'local': os.path.relpath(image.local_path, self.temp_path)})
+
+    @classmethod
+    def origins(cls, temp_path):
+        """
+        Gets where the files waiting in the temp folder were pulled from, so that files left by a killed run can still
+        be removed from their device once they're in the backup. Each device has its own journal, in its temp folder.
+        :param temp_path: The temp folder.
+        :return: Dictionary {local route: [device, remote route, hash]}
+        """
+        origins = {}
+        for root, dirs, files in os.walk(temp_path):
+            if cls.journal_name not in files:
+                continue
+            for record in cls.read(os.path.join(root, cls.journal_name)):
+                if record['event'] == 'pulled' and record.get('local') is not None:
+                    origins[os.path.normpath(os.path.join(root, record['local']))] = [record['device'], record['path'],
+                                                                                      record['hash']]
+        return origins
+
+    def write(self, record):
+        with self.lock:
+            self.journal.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self.journal.flush()
+
+    def close(self):
+        self.journal.close()
+
+
+class _ChunkReader(io.RawIOBase):
+    """File-like object reading the chunks yielded by streaming_shell."""
+
+    def __init__(self, chunks):
+        super(_ChunkReader, self).__init__()
+        self.chunks = iter(chunks)
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            try:
+                self.pending = next(self.chunks)
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+def list_files(device, to_search_path, recursive=False):
+    """
+    Lists the files of a device folder, yielding them while the listing goes on.
+    Recursive listings use a single find command, parsed line by line as it arrives. If find can't be used (older
+    toybox versions have no -printf), the folders are listed one by one through the sync protocol.
+    :param device: The connected AdbDeviceTcp.
+    :param to_search_path: The folder to list, ended with a slash.
+    :param recursive: List also the subfolders.
+    :return: Generator of AndroidPhoto-type objects.
+    """
+    yield from run_metrics.timed_iter('list', _list_files(device, to_search_path, recursive))
+
+
+def _list_files(device, to_search_path, recursive):
+    if not recursive:
+        yield from _list_folder(device, to_search_path, recursive=False)
+        return
+    listed = 0
+    unparsed = 0
+    for line in _stream_lines(device, 'find ' + shell_quote(to_search_path) + " -type f -printf '%s %T@ %p\\n'"):
+        try:
+            size, mtime, path = line.split(' ', 2)
+            image = _android_file(posixpath.dirname(path) + '/', posixpath.basename(path), int(size), int(float(mtime)))
+        except ValueError:
+            # The errors of find (e.g. "Permission denied" for a folder) come in the same stream.
+            unparsed += 1
+            continue
+        listed += 1
+        yield image
+    if unparsed and not listed:
+        # Not the expected output at all (no -printf), list the folders instead.
+        yield from _list_folder(device, to_search_path, recursive=True)
+
+
+def _stream_lines(device, command):
+    pending = b''
+    for chunk in device.streaming_shell(command, transport_timeout_s=100, read_timeout_s=100, decode=False):
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield line.decode('utf-8').rstrip('\r')
+    if pending.strip():
+        yield pending.decode('utf-8').rstrip('\r')
+
+
+def _list_folder(device, folder, recursive):
+    for file in device.list(folder, None, 9000):
+        name = file.filename.decode('utf-8')
+        if name in ('.', '..'):
+            continue
+        if stat.S_ISDIR(file.mode):
+            if recursive:
+                yield from _list_folder(device, folder + name + '/', recursive)
+        else:
+            yield _android_file(folder, name, file.size, file.mtime)
+
+
+def _android_file(folder, name, size, mtime):
+    image = AndroidPhoto()
+    image.name = name
+    image.path = folder
+    image.size = size
+    image.mtime = mtime
+    # Files of different folders (listed or subfolders) may have the same name, so the whole device folder is kept in
+    # the temp folder.
+    image.subfolder = folder.strip('/')
+    return image
+
+
+def shell_quote(text):
+    return "'" + text.replace("'", "'\\''") + "'"
+
+
+def chunk_arguments(command, arguments, max_length=max_command_length):
+    """
+    Splits a command with many arguments in several commands that fit in the command line limit.
+    :param command: The command, without arguments.
+    :param arguments: Array of (already quoted) arguments.
+    :param max_length: The maximum length of each command.
+    :return: Array of commands.
+    """
+    commands = []
+    actual = command
+    for argument in arguments:
+        if actual != command and len(actual) + 1 + len(argument) > max_length:
+            commands.append(actual)
+            actual = command
+        actual += ' ' + argument
+    if actual != command:
+        commands.append(actual)
+    return commands
+
+
+def _close(device):
+    try:
+        device.close()
+    except transport_errors:
+        pass
+
+
+def device_serial(device, remote_ip):
+    # The IP may change, the serial number identifies the device.
+    return device.shell('getprop ro.serialno').strip() or remote_ip
+
+
+def delete_files(device, paths):
+    """
+    Removes files from the device with as few rm commands as possible (each one fitting the command line limit).
+    :param device: The connected AdbDeviceTcp.
+    :param paths: Array of remote routes.
+    :return: None
+    """
+    with run_metrics.timed('delete', count=len(paths)):
+        for command in chunk_arguments('rm -f', [shell_quote(path) for path in paths]):
+            device.shell(command, transport_timeout_s=100, read_timeout_s=100)
+
+
+def device_hashes(device, images):
+    """
+    Gets the SHA-256 hash of the given files running sha256sum on the device, a few hundreds of files per command.
+    :param device: The connected AdbDeviceTcp.
+    :param images: Array of AndroidPhoto-type objects.
+    :return: Dictionary {remote path: hash}
+    """
+    folders = {}
+    for image in images:
+        folders.setdefault(image.path, []).append(shell_quote(image.name))
+    hashes = {}
+    with run_metrics.timed('device_hash', sum(image.size or 0 for image in images), len(images)):
+        for folder, names in folders.items():
+            # Relative names are shorter, so more of them fit in each command.
+            for command in chunk_arguments('cd ' + shell_quote(folder) + ' && sha256sum', names):
+                for line in device.shell(command, transport_timeout_s=100, read_timeout_s=100).splitlines():
+                    file_hash, _, name = line.partition('  ')
+                    if len(file_hash) == 64:
+                        hashes[folder + name] = file_hash
+    return hashes